@@ -8,6 +8,8 @@ import sys
 import re
 import json
 import os
+import time
+from multiprocessing import Pool
 
 
 def get_default_amr():
@@ -25,6 +27,32 @@ def write_to_file(lst, file_new, extra_newline=False):
     out_f.close()
 
 
+def sort_by_length(input_file, out_file, order_file, bucket_size=1):
+    '''Write the lines of input_file sorted by their number of tokens to out_file and the original (0-based) line number
+       of each sorted line to order_file. Lines in the same bucket of bucket_size tokens keep their original order'''
+    lines = [line.rstrip('\n') for line in open(input_file, 'r')]
+    order = sorted(range(len(lines)), key=lambda idx: len(lines[idx].split()) // bucket_size)
+    # Lines are written as they are, char-level lines can end with a space
+    with open(out_file, 'w') as out_f:
+        for idx in order:
+            out_f.write(lines[idx] + '\n')
+    write_to_file((str(idx) for idx in order), order_file)
+
+
+def restore_order(input_file, order_file):
+    '''Put the lines of a sorted file back in the original order (the inverse of sort_by_length), rewrites input_file'''
+    order = [int(line) for line in open(order_file, 'r')]
+    lines = [line.rstrip('\n') for line in open(input_file, 'r')]
+    if len(lines) != len(order):
+        raise ValueError('{0} has {1} lines, but {2} has {3}'.format(input_file, len(lines), order_file, len(order)))
+    original = [''] * len(order)
+    for line, idx in zip(lines, order):
+        original[idx] = line
+    with open(input_file, 'w') as out_f:
+        for line in original:
+            out_f.write(line + '\n')
+
+
 def get_files_by_ext(direc, ext):
     '''Function that traverses a directory and returns all files that match a certain extension'''
 
@@ -37,6 +65,50 @@ def get_files_by_ext(direc, ext):
     return return_files
 
 
+def process_file_safely(input_list):
+    '''Call func for a single file, return the error message instead of raising so other files still get processed'''
+    func, input_file, func_args = input_list
+    try:
+        func(input_file, *func_args)
+        return input_file, None
+    except Exception as e:
+        return input_file, '{0}: {1}'.format(type(e).__name__, e)
+
+
+def process_folder(folder, ext, func, func_args, threads):
+    '''Find all files in folder (and subfolders) that end with ext (string or tuple) and call func(file, *func_args)
+       for each of them in a pool of processes. Largest files are started first, a failing file does not stop the others'''
+    start = time.time()
+    files = sorted(get_files_by_ext(folder, ext), key=os.path.getsize, reverse=True)
+    pool = Pool(processes=threads)
+    failed = []
+    for input_file, error in pool.imap_unordered(process_file_safely, [[func, f, func_args] for f in files]):
+        if error:
+            failed.append((input_file, error))
+    pool.close()
+
+    # Summary of what we did
+    print('Processed {0} files in {1:.1f} seconds with {2} processes, {3} failed'.format(len(files), time.time() - start, threads, len(failed)))
+    for input_file, error in failed:
+        print('Failed: {0}\n\t{1}'.format(input_file, error))
+    return failed
+
+
+def stream_amrs(input_file):
+    '''Read a file with (multi-line) AMRs and yield them one by one as single lines, ignoring comments'''
+    cur_amr = []
+    for line in open(input_file, 'r'):
+        if not line.strip():
+            if cur_amr:
+                yield " ".join(cur_amr)
+                cur_amr = []
+        elif not line.startswith('#'):
+            cur_amr.append(line.strip())
+    # File did not end with newline
+    if cur_amr:
+        yield " ".join(cur_amr)
+
+
 def is_number(s):
     try:
         float(s)
@@ -163,6 +235,84 @@ def add_to_dict(d, key, base):
     return d
 
 
+class AMRNode(object):
+    '''Node of a parsed one-line AMR: variable, concept and a list of [relation, child] pairs,
+       in which the child is either an AMRNode or a string (re-entrant variable or constant)'''
+
+    def __init__(self, var, concept):
+        self.var = var
+        self.concept = concept
+        self.children = []
+        self.hash = None
+
+
+def tokenize_amr_tree(line):
+    '''Split one-line AMR in brackets, quoted strings and other tokens'''
+    return re.findall(r'"[^"]*"|[()]|[^\s()]+', line)
+
+
+def parse_amr_tree(line):
+    '''Parse a one-line AMR with variables, e.g. (w / want-01 :ARG0 (b / boy) :ARG1 (g / go-01 :ARG0 b)),
+       to a tree of AMRNodes. Raises a ValueError if the AMR is not well-formed'''
+    tokens = tokenize_amr_tree(line)
+    if not tokens or tokens[0] != '(':
+        raise ValueError('AMR does not start with a bracket: {0}'.format(line))
+    root, idx = parse_amr_node(tokens, 1)
+    if idx != len(tokens):
+        raise ValueError('Tokens left after parsing AMR: {0}'.format(line))
+    return root
+
+
+def parse_amr_node(tokens, idx):
+    '''Parse a node starting at tokens[idx] (just after the opening bracket), return the node
+       and the index of the token after the closing bracket'''
+    if idx + 2 >= len(tokens) or tokens[idx + 1] != '/':
+        raise ValueError('Expected variable and concept at position {0}'.format(idx))
+    node = AMRNode(tokens[idx], tokens[idx + 2])
+    idx += 3
+    while idx < len(tokens) and tokens[idx] != ')':
+        rel = tokens[idx]
+        if not rel.startswith(':') or idx + 1 >= len(tokens):
+            raise ValueError('Expected relation at position {0}, found {1}'.format(idx, rel))
+        if tokens[idx + 1] == '(':
+            child, idx = parse_amr_node(tokens, idx + 2)
+        elif tokens[idx + 1] == ')':
+            raise ValueError('Relation without value at position {0}'.format(idx))
+        else:
+            child, idx = tokens[idx + 1], idx + 2
+        node.children.append([rel, child])
+    if idx >= len(tokens):
+        raise ValueError('Missing closing bracket')
+    return node, idx + 1
+
+
+def amr_tree_to_string(node, with_vars=True):
+    '''Write a tree of AMRNodes back to a one-line AMR, possibly without variables'''
+    parts = ['(' + node.var + ' / ' + node.concept] if with_vars else ['(' + node.concept]
+    for rel, child in node.children:
+        if isinstance(child, AMRNode):
+            parts.append(rel + ' ' + amr_tree_to_string(child, with_vars))
+        else:
+            parts.append(rel + ' ' + child)
+    return " ".join(parts) + ')'
+
+
+def add_subtree_hashes(node, table=None):
+    '''Give each node in the tree a canonical hash (node.hash), computed bottom-up in one pass.
+       Subtrees get the same hash if they have the same concept and the same (relation, hash) children,
+       no matter the variables or the order of the children. Hashes are indices in table, so there are no collisions'''
+    if table is None:
+        table = {}
+    child_keys = []
+    for rel, child in node.children:
+        if isinstance(child, AMRNode):
+            child_keys.append((rel, add_subtree_hashes(child, table)))
+        else:
+            child_keys.append((rel, table.setdefault(child, len(table))))
+    node.hash = table.setdefault((node.concept, tuple(sorted(child_keys))), len(table))
+    return node.hash
+
+
 def countparens(text):
     ''' proper nested parens counting '''
     currcount=0
@@ -2,7 +2,8 @@
 # -*- coding: utf8 -*-
 
 '''Script that augments the data to get the best AMR permutation based on word order
-   INPUT SHOULD INCLUDE ALIGNMENTS
+   INPUT SHOULD INCLUDE ALIGNMENTS, unless -l is used. In that case the position of each concept
+   is estimated by matching its stem against the tokens of the sentence (# ::snt or # ::tok)
 
    It outputs the normal variable-free AMR as well as the best AMR permutation. Each AMR on a single line.
 
@@ -30,7 +31,9 @@
 import sys
 import re
 import argparse
-from random import shuffle
+import random
+from heapq import heappush, heappop
+import itertools
 from amr_utils import write_to_file
 from var_free_amrs import delete_wiki, delete_amr_variables, single_line_convert, remove_char_outside_quotes
 
@@ -41,6 +44,11 @@ def create_arg_parser():
     parser.add_argument("-a", "--amr_ext", default='.txt', type=str, help="AMR extension (default .txt) - should have alignments")
     parser.add_argument("-c", "--cut_off", default=15, type=int, help="When to cut-off number of permutations")
     parser.add_argument("-d", "--double", action='store_true', help="Add best permutation AMR AND normal AMR")
+    parser.add_argument("-k", "--num_perms", default=0, type=int, help="Write up to this many distinct orderings per AMR to .tf.perms (and .sent.perms)")
+    parser.add_argument("-m", "--perm_mode", default='kbest', choices=['kbest', 'random'], help="After the best order, add the orders closest to the word order (kbest) or random orders (default kbest)")
+    parser.add_argument("-s", "--samples", default=10, type=int, help="Number of orders we try per wanted permutation, as different orders can give the same AMR (default 10)")
+    parser.add_argument("-se", "--seed", default=1, type=int, help="Seed for the random orders, so that the output can be reproduced (default 1)")
+    parser.add_argument("-l", "--lexical", action='store_true', help="No alignments in input: estimate them by matching concepts to the sentence")
     args = parser.parse_args()
     return args
 
@@ -127,6 +135,14 @@ def get_sense(word):
     return sense, word
 
 
+def remove_sense(word):
+    '''Tricky: we want to change break-01 to break, but do not want to screw up dates (08-09-2016 or 28-10)'''
+    num_digits = sum(c.isdigit() for c in word)
+    if word.count('-') == 1 and num_digits < 3 and num_digits > 0:
+        word = word.split('-')[0]
+    return word
+
+
 def find_words(line):
     '''Finds all words in the AMR structure'''
     comb = []
@@ -147,11 +163,7 @@ def find_words(line):
                     comb += get_word_and_sense(cut_word)
                 else:
                     sense, word = get_sense(word)
-                    num_digits = sum(c.isdigit() for c in word)
-                    # Tricky: we want to change break-01 to break, but do not want to screw up dates (08-09-2016 or 28-10)
-                    if word.count('-') == 1 and num_digits < 3 and num_digits > 0:
-                        word = word.split('-')[0]
-                    comb.append([word, sense])
+                    comb.append([remove_sense(word), sense])
 
     # Add empty sense if needed
     for idx, value in enumerate(comb):
@@ -172,6 +184,9 @@ def matching_words(permutations):
 
 def calc_distance(l):
     '''Calculates distance between list items in two lists'''
+    # Nothing aligned (can happen a lot for lexical alignments), so nothing to compare
+    if not any(x[1] != '' for x in l):
+        return 0
     # l needs to start from zero, get lowest number and substract it from all numbers
     min_l = min([int(x[1]) for x in l if x[1] != ''])
     l = [[x[0], (x[1] - min_l)] for x in l if x[1] != '']
@@ -278,7 +293,7 @@ def get_keep_string(new_parts, level):
 def combine_permutations(permutations, cut_off):
     '''Combine permutations if they exceed the cut-off specified'''
     if len(permutations) > cut_off:
-        shuffle(permutations)
+        random.shuffle(permutations)
         # Add extra permutations to the last permutation
         # to avoid losing information
         permutations = permutations[0:cut_off - 1] + [" ".join(permutations[cut_off - 1:])]
@@ -293,7 +308,7 @@ def change_possible(part):
         return True
 
 
-def get_permutations(part, level, all_perms, type_script, cut_off):
+def get_permutations(part, level, all_perms, cut_off):
     '''Function that returns the permutations in the best order'''
     # Make life easier by skipping first '(' or ':'
     part = part[1:]
@@ -317,36 +332,20 @@ def get_permutations(part, level, all_perms, type_script, cut_off):
     # Find the list of lists that contain word-sense pairs
     word_list = matching_words(permutations)
 
-    # Two possibilities here, ordering or pruning. This script only does ordering,
-    # but prune_amrs.py does pruning and uses this function as well
-    if type_script == 'prune':
-        permutations_set = []
-        for p in permutations:
-            # Remove all nodes with same parent
-            if p in permutations_set:
-                continue
-            elif p not in all_perms:
-                permutations_set.append(p)
-            elif all_perms.count(p) < 2:
-                # If we saw the node twice, stop adding
-                permutations_set.append(p)
-            all_perms.append(p)
-        return permutations_set, keep_string, all_perms
+    if len(word_list) != len(permutations):
+        # Something strange is going on here, just ignore it and do nothing to avoid errors
+        print('Strange AMR part')
+        all_perms += permutations
+        return permutations, keep_string, all_perms
     else:
-        if len(word_list) != len(permutations):
-            # Something strange is going on here, just ignore it and do nothing to avoid errors
-            print('Strange AMR part')
-            all_perms += permutations
-            return permutations, keep_string, all_perms
-        else:
-            for p in range(len(permutations)):
-                for idx in range(len(permutations)-1):
-                    # Permuting takes place here, check if swapping results in better order
-                    if do_swap(word_list[idx], word_list[idx+1]):
-                        permutations[idx], permutations[idx+1] = permutations[idx+1], permutations[idx]
-                        word_list[idx], word_list[idx+1] = word_list[idx+1], word_list[idx]
-            all_perms += permutations
-            return permutations, keep_string, all_perms
+        for p in range(len(permutations)):
+            for idx in range(len(permutations)-1):
+                # Permuting takes place here, check if swapping results in better order
+                if do_swap(word_list[idx], word_list[idx+1]):
+                    permutations[idx], permutations[idx+1] = permutations[idx+1], permutations[idx]
+                    word_list[idx], word_list[idx+1] = word_list[idx+1], word_list[idx]
+        all_perms += permutations
+        return permutations, keep_string, all_perms
 
 
 def do_string_adjustments(permutations_new, keep_string2):
@@ -380,31 +379,31 @@ def fix_paren(string):
     return string
 
 
-def get_best_perm(permutations, final_string, all_perms, type_script, cut_off):
+def get_best_perm(permutations, final_string, all_perms, cut_off):
     '''This must also be possible recursive - I tried...
        For each (sub)-AMR, get the best permutation based on input words'''
     for p2 in permutations:
-        permutations_2, keep_string2, all_perms = get_permutations(p2, 2, all_perms, type_script, cut_off)
+        permutations_2, keep_string2, all_perms = get_permutations(p2, 2, all_perms, cut_off)
         for p3 in permutations_2:
-            permutations_3, keep_string3, all_perms = get_permutations(p3, 3, all_perms, type_script, cut_off)
+            permutations_3, keep_string3, all_perms = get_permutations(p3, 3, all_perms, cut_off)
             for p4 in permutations_3:
-                permutations_4, keep_string4, all_perms = get_permutations(p4, 4, all_perms, type_script, cut_off)
+                permutations_4, keep_string4, all_perms = get_permutations(p4, 4, all_perms, cut_off)
                 for p5 in permutations_4:
-                    permutations_5, keep_string5, all_perms = get_permutations(p5, 5, all_perms, type_script, cut_off)
+                    permutations_5, keep_string5, all_perms = get_permutations(p5, 5, all_perms, cut_off)
                     for p6 in permutations_5:
-                        permutations_6, keep_string6, all_perms = get_permutations(p6, 6, all_perms, type_script, cut_off)
+                        permutations_6, keep_string6, all_perms = get_permutations(p6, 6, all_perms, cut_off)
                         for p7 in permutations_6:
-                            permutations_7, keep_string7, all_perms = get_permutations(p7, 7, all_perms, type_script, cut_off)
+                            permutations_7, keep_string7, all_perms = get_permutations(p7, 7, all_perms, cut_off)
                             for p8 in permutations_7:
-                                permutations_8, keep_string8, all_perms = get_permutations(p8, 8, all_perms, type_script, cut_off)
+                                permutations_8, keep_string8, all_perms = get_permutations(p8, 8, all_perms, cut_off)
                                 for p9 in permutations_8:
-                                    permutations_9, keep_string9, all_perms = get_permutations(p9, 9, all_perms, type_script, cut_off)
+                                    permutations_9, keep_string9, all_perms = get_permutations(p9, 9, all_perms, cut_off)
                                     for p10 in permutations_9:
-                                        permutations_10, keep_string10, all_perms = get_permutations(p10, 10, all_perms, type_script, cut_off)
+                                        permutations_10, keep_string10, all_perms = get_permutations(p10, 10, all_perms, cut_off)
                                         for p11 in permutations_10:
-                                            permutations_11, keep_string11, all_perms = get_permutations(p11, 11, all_perms, type_script, cut_off)
+                                            permutations_11, keep_string11, all_perms = get_permutations(p11, 11, all_perms, cut_off)
                                             for p12 in permutations_11:
-                                                permutations_12, keep_string12, all_perms = get_permutations(p12, 12, all_perms, type_script, cut_off)
+                                                permutations_12, keep_string12, all_perms = get_permutations(p12, 12, all_perms, cut_off)
                                                 add_string = do_string_adjustments(permutations_12, keep_string12)
                                                 keep_string11 += add_string.replace('  ', ' ')
                                             keep_string10 += fix_paren(keep_string11)
@@ -431,18 +430,14 @@ def process_file_best(amrs, sent_amrs, cut_off):
     for idx, amr in enumerate(amrs):
         # Only try to do something if we can actually permute
         if amr.count(':') > 1:
-            permutations, keep_string1, _ = get_permutations(amr, 1, [], 'order', cut_off)
-            final_string = get_best_perm(permutations, '(' + keep_string1, [], 'order', cut_off)
             # Save final output string
-            save_all_amrs.append(create_final_line(final_string))
+            save_all_amrs.append(permute_amr(amr, cut_off))
         else:
             # Just save AMR if there's nothing to do
             save_all_amrs.append(remove_alignment(amr))
 
-    # Fix tokenization and remove alignment
-    for idx, amr in enumerate(amrs):
-        amrs[idx] = amr.replace(' )', ')')
-        amrs[idx] = remove_alignment(amr)
+    # Remove alignment, keep the input list (with alignments) intact
+    amrs = [remove_alignment(amr) for amr in amrs]
 
     # Print how many AMRs we actually changed by doing this
     changed_amrs = len(amrs) -  len([i for i, j in zip(amrs, save_all_amrs) if i == j])
@@ -450,6 +445,225 @@ def process_file_best(amrs, sent_amrs, cut_off):
     return save_all_amrs, amrs
 
 
+def get_token_index(sent, prefix_len):
+    '''Map each (lowercased) token of the sentence to its positions, also keep an index on the
+       prefix of the tokens so that we can match stems such as innovate with innovation'''
+    token_index, prefix_index = {}, {}
+    for idx, tok in enumerate(sent.lower().split()):
+        tok = tok.strip('.,;:!?"\'()')
+        if tok:
+            token_index.setdefault(tok, []).append(idx)
+            prefix_index.setdefault(tok[:prefix_len], set()).add(tok)
+    return token_index, prefix_index
+
+
+def find_token_position(stem, token_index, prefix_index, used, prefix_len):
+    '''Find the sentence position for a concept stem, prefer exact matches and unused positions'''
+    stem = stem.lower()
+    if stem in token_index:
+        positions = token_index[stem]
+    else:
+        # Stem should match the token, apart from the last two characters (innovate - innovation)
+        min_match = min(len(stem), max(prefix_len, len(stem) - 2))
+        positions = []
+        for tok in prefix_index.get(stem[:prefix_len], []):
+            if len(tok) >= min_match and tok[:min_match] == stem[:min_match]:
+                positions += token_index[tok]
+        positions.sort()
+    if not positions:
+        return ''
+    # Concepts that occur multiple times get the next token that was not used yet
+    for pos in positions:
+        if pos not in used:
+            used.add(pos)
+            return pos
+    return positions[0]
+
+
+def add_lexical_alignment(amr, sent, prefix_len=4):
+    '''Add alignments (e.g. establish-01~e.0) to a single-line AMR without alignments,
+       by matching the concepts and names directly against the sentence'''
+    token_index, prefix_index = get_token_index(sent, prefix_len)
+    used = set()
+
+    def align(match):
+        if match.group(1):
+            # Name or other constant between quotes
+            pos = find_token_position(match.group(1)[1:-1], token_index, prefix_index, used, prefix_len)
+        elif match.group(2) == 'name':
+            # Name concepts are never aligned, their :op values are
+            return match.group(0)
+        else:
+            pos = find_token_position(remove_sense(match.group(2)), token_index, prefix_index, used, prefix_len)
+        if pos == '':
+            return match.group(0)
+        return '{0}~e.{1}'.format(match.group(0), pos)
+
+    return re.sub(r'("[^"]+")|(?<=\()([^\s()":~]+)', align, remove_alignment(amr))
+
+
+def add_lexical_alignments(amrs, sent_amrs):
+    '''Add lexical alignments for all AMRs, sentences should be in the same order'''
+    assert len(amrs) == len(sent_amrs), "{0} vs {1}".format(len(amrs), len(sent_amrs))
+    return [add_lexical_alignment(amr, sent) for amr, sent in zip(amrs, sent_amrs)]
+
+
+def permute_amr(amr, cut_off):
+    '''Return the AMR (with alignment) in the order that best matches the word order of the sentence'''
+    permutations, keep_string1, _ = get_permutations(amr, 1, [], cut_off)
+    final_string = get_best_perm(permutations, '(' + keep_string1, [], cut_off)
+    return create_final_line(final_string)
+
+
+class PermNode(object):
+    '''Node of a parsed variable-free AMR with alignments: concept, children as [relation, child] pairs
+       (child is a PermNode or a constant) and the first aligned token position in the subtree (anchor)'''
+
+    def __init__(self, concept):
+        self.concept = concept
+        self.children = []
+        self.anchor = ''
+
+
+def parse_perm_tree(amr):
+    '''Parse a variable-free AMR with alignments (e.g. (model~e.1 :mod~e.2 (innovate-01~e.4))) once,
+       return None if the AMR is not well-formed'''
+    tokens = re.findall(r'"[^"]*"(?:~e\.[\d,]+)?|[()]|[^\s()]+', amr)
+    if not tokens or tokens[0] != '(':
+        return None
+    try:
+        root, idx = parse_perm_node(tokens, 1)
+    except (IndexError, ValueError):
+        return None
+    return root if idx == len(tokens) else None
+
+
+def parse_perm_node(tokens, idx):
+    '''Parse a node starting just after its opening bracket, return the node and the index after its closing bracket'''
+    if tokens[idx] in '()':
+        raise ValueError('Expected concept at position {0}'.format(idx))
+    node = PermNode(tokens[idx])
+    anchors = [get_sense(tokens[idx])[0]]
+    idx += 1
+    while tokens[idx] != ')':
+        rel = tokens[idx]
+        if tokens[idx + 1] == '(':
+            child, idx = parse_perm_node(tokens, idx + 2)
+            anchors.append(child.anchor)
+        elif tokens[idx + 1] == ')':
+            raise ValueError('Relation without value at position {0}'.format(idx))
+        else:
+            child, idx = tokens[idx + 1], idx + 2
+            anchors.append(get_sense(child)[0])
+        node.children.append([rel, child])
+    aligned = [a for a in anchors if a != '']
+    node.anchor = min(aligned) if aligned else ''
+    return node, idx + 1
+
+
+def order_cost(anchors):
+    '''Number of aligned children that are in the wrong order compared to the sentence'''
+    return sum(1 for i in range(len(anchors)) for j in range(i + 1, len(anchors))
+               if anchors[i] != '' and anchors[j] != '' and anchors[i] > anchors[j])
+
+
+def ranked_orders(node, k, max_enum=6):
+    '''Up to k orders of the children of node as (cost, order) pairs, sorted by their cost.
+       With more than max_enum children we only consider the sorted order and its adjacent swaps'''
+    anchors = [child.anchor if isinstance(child, PermNode) else get_sense(child)[0] for _, child in node.children]
+    if len(anchors) <= max_enum:
+        orders = itertools.permutations(range(len(anchors)))
+    else:
+        best = sorted(range(len(anchors)), key=lambda i: (anchors[i] == '', anchors[i] if anchors[i] != '' else i))
+        orders = [best] + [best[:i] + [best[i + 1], best[i]] + best[i + 2:] for i in range(len(best) - 1)]
+    ranked = sorted((order_cost([anchors[i] for i in order]), tuple(order)) for order in orders)
+    return ranked[:k]
+
+
+def perm_nodes(node):
+    '''All nodes of the tree that have more than one child, so that can be permuted'''
+    nodes = [node] if len(node.children) > 1 else []
+    for _, child in node.children:
+        if isinstance(child, PermNode):
+            nodes += perm_nodes(child)
+    return nodes
+
+
+def perm_tree_to_string(node, orders):
+    '''Write the tree back to a single-line AMR, using the order of orders[id(node)] for the children'''
+    order = orders.get(id(node), range(len(node.children)))
+    parts = [node.concept]
+    for i in order:
+        rel, child = node.children[i]
+        parts.append(rel + ' ' + (perm_tree_to_string(child, orders) if isinstance(child, PermNode) else child))
+    return '(' + " ".join(parts) + ')'
+
+
+def kbest_orders(nodes, ranked):
+    '''Generate the combinations of the per-node orders with the lowest total cost first. Since the cost
+       of each node only depends on the order of its own children, this gives the true k-best orderings'''
+    start = (0,) * len(nodes)
+    heap = [(sum(r[0][0] for r in ranked), start)]
+    seen = {start}
+    while heap:
+        cost, choice = heappop(heap)
+        yield {id(node): ranked[i][choice[i]][1] for i, node in enumerate(nodes)}
+        for i in range(len(nodes)):
+            if choice[i] + 1 < len(ranked[i]):
+                nxt = choice[:i] + (choice[i] + 1,) + choice[i + 1:]
+                if nxt not in seen:
+                    seen.add(nxt)
+                    heappush(heap, (cost - ranked[i][choice[i]][0] + ranked[i][choice[i] + 1][0], nxt))
+
+
+def random_orders(nodes):
+    '''Generate random orders of the children of each node'''
+    while True:
+        orders = {}
+        for node in nodes:
+            order = list(range(len(node.children)))
+            random.shuffle(order)
+            orders[id(node)] = order
+        yield orders
+
+
+def get_multiple_perms(amr, best, num_perms, perm_mode, samples):
+    '''Get up to num_perms distinct orderings of the AMR: the best one first, followed by either random
+       orders or the k-best orders by distance to the word order. The AMR is only parsed once'''
+    perms = [best]
+    root = parse_perm_tree(amr)
+    if root is None:
+        return perms
+    nodes = perm_nodes(root)
+    if not nodes:
+        return perms
+    if perm_mode == 'random':
+        orders = random_orders(nodes)
+    else:
+        orders = kbest_orders(nodes, [ranked_orders(node, num_perms) for node in nodes])
+    # Different orders can still give the same string (e.g. identical siblings), so limit the tries
+    for _, order in zip(range(num_perms * samples), orders):
+        if len(perms) >= num_perms:
+            break
+        cand = remove_alignment(perm_tree_to_string(root, order))
+        if cand not in perms:
+            perms.append(cand)
+    return perms
+
+
+def process_file_multi(amrs, best_amrs, sent_amrs, num_perms, perm_mode, samples, amr_file, sent_file):
+    '''Write multiple orderings per AMR, together with the matching sentences, directly to file'''
+    assert len(amrs) == len(sent_amrs) == len(best_amrs)
+    total = 0
+    with open(amr_file, 'w') as amr_f, open(sent_file, 'w') as sent_f:
+        for amr, best, sent in zip(amrs, best_amrs, sent_amrs):
+            for perm in get_multiple_perms(amr, best, num_perms, perm_mode, samples):
+                amr_f.write(perm.strip() + '\n')
+                sent_f.write(sent.strip() + '\n')
+                total += 1
+    print('Wrote {0} AMRs for {1} input AMRs'.format(total, len(amrs)))
+
+
 def preprocess(f_path):
     '''Preprocess the AMR file, deleting variables/wiki-links and tokenizing'''
     # Delete Wiki links from AMRs
@@ -463,7 +677,7 @@ def preprocess(f_path):
 
 def create_output(input_file, old_amrs, new_amrs, sent_amrs, double, amr_ext):
     '''Print output to the correct files - also keep no-var AMR'''
-    permuted_amr, no_var_amr, sent_file, double_sent_file, double_amr_file = get_filenames(input_file, amr_ext)
+    permuted_amr, no_var_amr, sent_file, double_sent_file, double_amr_file, _, _ = get_filenames(input_file, amr_ext)
     write_to_file(old_amrs, no_var_amr)
     write_to_file(new_amrs, permuted_amr)
     write_to_file(sent_amrs, sent_file)
@@ -480,12 +694,23 @@ def get_filenames(input_file, amr_ext):
     sent_file = input_file.replace(amr_ext, '.sent')
     double_sent = input_file.replace(amr_ext, '.sent.double')
     double_amr = input_file.replace(amr_ext, '.tf.double')
-    return permuted_amr, no_var_amr, sent_file, double_sent, double_amr
+    perms_sent = input_file.replace(amr_ext, '.sent.perms')
+    perms_amr = input_file.replace(amr_ext, '.tf.perms')
+    return permuted_amr, no_var_amr, sent_file, double_sent, double_amr, perms_sent, perms_amr
 
 
 if __name__ == '__main__':
     args = create_arg_parser()
+    random.seed(args.seed)
     sent_amrs, old_amrs = preprocess(args.input_file)
-    new_amrs, old_amrs = process_file_best(old_amrs, sent_amrs, args.cut_off)
+    # Estimate the alignments ourselves if the input has none
+    if args.lexical:
+        old_amrs = add_lexical_alignments(old_amrs, sent_amrs)
+    new_amrs, no_align_amrs = process_file_best(old_amrs, sent_amrs, args.cut_off)
+    # Multiple orderings per AMR are written while we create them, starting with the best order
+    if args.num_perms > 0:
+        _, _, _, _, _, perms_sent, perms_amr = get_filenames(args.input_file, args.amr_ext)
+        process_file_multi(old_amrs, new_amrs, sent_amrs, args.num_perms, args.perm_mode, args.samples, perms_amr, perms_sent)
+    old_amrs = no_align_amrs
     # Write output to file
     create_output(args.input_file, old_amrs, new_amrs, sent_amrs, args.double, args.amr_ext)
@@ -16,11 +16,15 @@
    ( e s t a b l i s h - 0 1 + :ARG1 + ( m o d e l + :mod + ( i n n o v a t e - 0 1 + :ARG1 + ( i n d u s t r y ) ) ) )'''
 
 
+import os
 import sys
 import re
 import argparse
-import os
-from amr_utils import write_to_file
+from array import array
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+from amr_utils import write_to_file, process_folder, sort_by_length, get_files_by_ext
 
 
 def create_arg_parser():
@@ -32,138 +36,334 @@ def create_arg_parser():
     parser.add_argument('-s', '--super_chars', action='store_true', help='Adding super characters for AMR files')
     parser.add_argument('-c', '--coreference', action='store_true', help='If there is path-coreference or index-coreference in the input')
     parser.add_argument('-p', '--pos', action='store_true', help='Whether input is POS-tagged')
+    parser.add_argument('-r', '--round_trip', action='store_true', help='Check that decoding the output gives back the input (not for POS-tagged files), raises an error if it does not')
+    parser.add_argument('-ids', '--ids', action='store_true', help='Also write the token ids of the output as NumPy arrays (.ids.npy and .offsets.npy), with a new frequency-sorted .vocab file if no vocab is given (a single one for all files with -fol, e.g. char.tf.vocab in the folder)')
+    parser.add_argument('-va', '--vocab_amr', default='', type=str, help='Existing vocab file to encode AMR files with, prints the OOV rate')
+    parser.add_argument('-vs', '--vocab_sent', default='', type=str, help='Existing vocab file to encode sentence files with, prints the OOV rate')
+    parser.add_argument('-sl', '--sort_length', default=0, type=int, help='Also write a copy of the output sorted by length (.sorted) and the original line numbers (.order), lines in the same bucket of this many tokens keep their order (1 sorts exactly, default 0: no copy)')
+    parser.add_argument('-t', '--threads', default=16, type=int, help="Number of processes the lines of a large file are divided over, or the number of files processed in parallel when using -fol (default 16)")
     args = parser.parse_args()
     return args
 
 
-def get_fixed_lines(file_lines, coreference):
-    '''Fix lines, filter out non-relation and put back coreference paths'''
+# Relations with these characters are not structure words (links etc) and are put in char-level after all
+no_relation_chars = [')', '<', ')', '>', '/', 'jwf9X']
+# Coreference-specific: change | 1 | to |1|, as to not treat the indexes as normal numbers, but as separate super characters
+# Also change * 1 * to *1* and * 1 2 * to *12*
+coref_path_re = re.compile(r'\| (\d) \|')
+coref_index_re = re.compile(r'\* (\d) \*')
+coref_double_index_re = re.compile(r'\* (\d) (\d) \*')
+# Relation that is kept as super character: starts with ':' and a letter, runs until a '+' or the next relation
+# and has none of the no_relation_chars in it (only used for ASCII lines without tabs etc, see super_char_line)
+relation_re = re.compile(r'(:(?=[A-Za-z])(?:(?!jwf9X)(?:[^+:)<>/]|:(?![A-Za-z])))*(?=\+|:[A-Za-z]|\Z))')
+other_space_re = re.compile(r'[^\S ]')
 
-    fixed_lines = []
 
-    for line in file_lines:
-        spl = line.split()
-        for idx, item in enumerate(spl):
-            if len(item) > 1 and item[0] == ':':
-                # Filter out non-structure words, due to links etc
-                if any(x in item for x in [')', '<', ')', '>', '/', 'jwf9X']):
-                    new_str = ''
-                    for ch in item:
-                        new_str += ch + ' '
-                    spl[idx] = new_str.strip()
-        fixed_lines.append(" ".join(spl))
+def char_level_line(line):
+    '''Put a line in char-level format without super characters: spaces become +, all characters are followed by a space
+       The line ending is kept as is, so that the output is the same as the sed command we used before'''
+    text = line[:-1] if line.endswith('\n') else line
+    if not text:
+        return line
+    return ' '.join(text.replace(' ', '+')) + ' ' + line[len(text):]
 
-    # Step that is coreference-specific: change | 1 | to |1|, as to not treat the indexes as normal numbers, but as separate super characters
-    # Also change * 1 * to *1* and * 1 2 * to *12*
-    if coreference:
-        new_lines = []
-        for l in fixed_lines:
-            new_l = re.sub(r'\| (\d) \|', r'|\1|', l)
-            new_l = re.sub(r'\* (\d) \*', r'*\1*', new_l)
-            new_l = re.sub(r'\* (\d) (\d) \*', r'*\1\2*', new_l)
-            new_lines.append(new_l)
-        return new_lines
+
+def relation_segment(segment):
+    '''Split a part of an AMR without spaces in char-level tokens: a relation starts at a ':' that is followed by
+       a letter and is a single token until the next relation, other characters are separate tokens'''
+    parts = segment.split(':')
+    tokens = list(parts[0])
+    relation = ''
+    for part in parts[1:]:
+        # After ':' there should always be a letter, otherwise it is some URL probably and we just continue
+        if part[:1].isalpha():
+            tokens.extend(relation_tokens(relation))
+            relation = ':' + part
+        elif relation:
+            relation += ':' + part
+        else:
+            tokens.extend(':' + part)
+    tokens.extend(relation_tokens(relation))
+    return tokens
+
+
+def relation_tokens(relation):
+    '''Filter out non-structure words, due to links etc, by putting them in char-level after all'''
+    return [" ".join(tok) if tok[0] == ':' and len(tok) > 1 and any(x in tok for x in no_relation_chars) else tok for tok in relation.split()]
+
+
+def super_char_line(line, coreference):
+    '''Put an AMR line in character-level format with the relations as super characters, filter out
+       non-relations and put back coreference paths'''
+    # Replace actual spaces with '+', which is a token by itself
+    line = line.replace(' ', '+').rstrip('\n')
+    if line.isascii() and not other_space_re.search(line):
+        # Most lines: the relations are found by a single regex, all other characters are separate
+        parts = relation_re.split(line)
+        new_line = " ".join(part if idx % 2 else " ".join(part) for idx, part in enumerate(parts) if part)
     else:
-        return fixed_lines
-
-
-def get_amr_lines(f_path):
-    '''Put AMR lines in character-level format'''
-    file_lines = []
-    for line in open(f_path, 'r'):
-        # Replace actual spaces with '+'
-        line = line.replace(' ', '+')
-        new_l = ''
-        add_space = True
-        for idx, ch in enumerate(line):
-            # After ':' there should always be a letter, otherwise it is some URL probably and we just continue
-            if ch == ':' and line[idx+1].isalpha():
-                add_space = False
-                new_l += ' ' + ch
-            elif ch == '+':
-                add_space = True
-                new_l += ' ' + ch
-            else:
-                if add_space:
-                    new_l += ' ' + ch
-                else:
-                    # We previously saw a ':', so we do not add a space
-                    new_l += ch
-        file_lines.append(new_l)
-    return file_lines
-
-
-def process_pos_tagged(f_path):
-    '''Process a POS-tagged sentence file'''
-    fixed_lines = []
-
-    for line in open(f_path, 'r'):
-        new_l = ''
-        no_spaces = False
-        # Replace actual spaces with '+'
-        line = line.replace(' ', '+')
-        for idx, ch in enumerate(line):
-            if ch == '|':
-                # Skip identifier '|' in the data
-                no_spaces = True
-                new_l += ' '
-            elif ch == ':' and line[idx-1] == '|':
-                # Structure words are also chunks
-                no_spaces = True
-            elif ch == '+':
-                no_spaces = False
-                new_l += ' ' + ch
-            elif no_spaces:
-                # Only do no space when uppercase letters (VBZ, NNP, etc), special case PRP$    (not necessary)
-                new_l += ch
-            else:
-                new_l += ' ' + ch
-        fixed_lines.append(new_l)
-    return fixed_lines
-
-
-def char_level_file(input_file, amr_ext, sent_ext, pos, super_chars, coreference):
-    '''Given an input file, put it in char-level format and write output'''
+        tokens = []
+        for segment in line.split('+'):
+            tokens.extend(relation_segment(segment) if ':' in segment else segment)
+            tokens.append('+')
+        new_line = " ".join(" ".join(tokens[:-1]).split())
+    if coreference:
+        new_line = coref_path_re.sub(r'|\1|', new_line)
+        new_line = coref_index_re.sub(r'*\1*', new_line)
+        new_line = coref_double_index_re.sub(r'*\1\2*', new_line)
+    return new_line
+
+
+def pos_tagged_line(line):
+    '''Put a POS-tagged sentence in character-level format, POS-tags (after the identifier |) and
+       structure words (|:) are kept as single characters'''
+    new_segments = []
+    # Replace actual spaces with '+', which resets the POS-tag
+    for idx, segment in enumerate(line.replace(' ', '+').split('+')):
+        # Special case: a ':' at the start follows the '|' at the end of the line (as line[-1])
+        if idx == 0 and segment.startswith(':') and line.endswith('|'):
+            word, sep, tag = '', '', segment[1:]
+        else:
+            word, sep, tag = segment.partition('|')
+            # Structure words are also chunks, the ':' itself is skipped
+            if tag.startswith(':'):
+                tag = tag[1:]
+        new_seg = ' ' + ' '.join(word) if word else ''
+        # Skip identifier '|' in the data, there are no spaces in the POS-tag itself
+        new_seg += sep.replace('|', ' ') + tag.replace('|:', '|').replace('|', ' ')
+        new_segments.append(new_seg)
+    return ' +'.join(new_segments)
+
+
+class CharCodec(object):
+    '''Encoder and decoder between word-level and char-level lines, both with and without super characters
+       Decoding does not depend on the mode: it removes the spaces between the characters and changes + back to a
+       space. The only literal + that is restored is the one of :polite +, which is the only + in AMRs outside quotes.
+       For AMRs a + in quotes stays a +, so decoding only gives back the input if quoted strings have no spaces'''
+    def __init__(self, super_chars=False, coreference=False, amr=True):
+        self.super_chars = super_chars
+        self.coreference = coreference
+        self.amr = amr
+
+    def encode(self, line):
+        '''Put a single line (without line ending) in char-level format'''
+        line = line.rstrip('\n')
+        return super_char_line(line, self.coreference) if self.super_chars else char_level_line(line)
+
+    def decode(self, line):
+        '''Put a single char-level line back in word-level format, every + outside quotes is a space
+           This is also the decoder of model output, so double + are not literal + (except after :polite)
+           Subword output (subword_AMR.py) is joined as well, @@ marks a subword that continues in the next token
+           Word-level input with :polite + is also decoded to :polite +, the space would otherwise be removed'''
+        line = line.replace(':polite +', ':polite++').replace('@@ ', '').replace(' ', '')
+        if not self.amr:
+            return line.replace('+', ' ')
+        parts = line.split('"')
+        parts[::2] = [part.replace('+', ' ').replace(':polite  ', ':polite +') for part in parts[::2]]
+        return '"'.join(parts)
+
+
+def check_round_trip(input_file, out_file, codec):
+    '''Check that decoding the char-level lines of out_file gives back the lines of input_file, print the mismatches'''
+    mismatches = 0
+    with open(input_file, 'r') as in_f, open(out_file, 'r') as out_f:
+        for line_num, (line, char_line) in enumerate(zip(in_f, out_f), 1):
+            line, decoded = line.rstrip('\n'), codec.decode(char_line.rstrip('\n'))
+            if decoded != line:
+                mismatches += 1
+                # Only show the first few, there might be a lot of them
+                if mismatches <= 5:
+                    print('Line {0} does not round-trip:\n\t{1}\n\t{2}'.format(line_num, line, decoded))
+    print('Round-trip check: {0} lines did not decode to the input'.format(mismatches))
+    return mismatches
+
+
+def encode_line(input_list):
+    '''Put a single line in char-level format, mode is chars, super or pos, returns the line with newline'''
+    line, mode, coreference = input_list
+    if mode == 'chars':
+        return char_level_line(line)
+    elif mode == 'super':
+        return super_char_line(line, coreference).strip() + '\n'
+    return pos_tagged_line(line).strip() + '\n'
+
+
+class VocabIds:
+    '''Token ids of char-level lines, collected while writing them. Either a new vocab is built on the fly
+       (sorted by frequency when saving) or the tokens are looked up in an existing vocab, counting the OOVs'''
+    special_tokens = ['<pad>', '<unk>']
+
+    def __init__(self, vocab_file=''):
+        self.fixed = bool(vocab_file)
+        self.vocab = load_vocab(vocab_file) if vocab_file else {tok: idx for idx, tok in enumerate(self.special_tokens)}
+        self.unk = self.vocab[self.special_tokens[1]]
+        self.counts = Counter()
+        self.oov = Counter()
+        # Token ids of all lines after each other, offsets[i] is where line i starts
+        self.ids = array('i')
+        self.offsets = array('q', [0])
+
+    def add(self, line):
+        '''Add the tokens of a single char-level line'''
+        tokens = line.split()
+        if self.fixed:
+            ids = [self.vocab.get(tok, self.unk) for tok in tokens]
+            if self.unk in ids:
+                self.oov.update(tok for tok in tokens if tok not in self.vocab)
+        else:
+            self.counts.update(tokens)
+            ids = [self.vocab.setdefault(tok, len(self.vocab)) for tok in tokens]
+        self.ids.extend(ids)
+        self.offsets.append(len(self.ids))
+
+    def print_oov(self):
+        '''Print the OOV rate of the tokens compared to the existing vocab'''
+        num_oov = sum(self.oov.values())
+        print('OOV: {0} of {1} tokens ({2:.2f}%), {3} different OOV tokens'.format(num_oov, len(self.ids), 100.0 * num_oov / max(len(self.ids), 1), len(self.oov)))
+        if self.oov:
+            print('Most frequent OOV tokens: {0}'.format(" ".join(tok for tok, _ in self.oov.most_common(10))))
+
+    def save(self, out_file, write_ids):
+        '''Write the new vocab (if we built one) to out_file.vocab and the ids to out_file.ids.npy and out_file.offsets.npy,
+           the arrays can be memory-mapped with numpy.load(file, mmap_mode='r')'''
+        if self.fixed and not write_ids:
+            return
+        # NumPy is only needed for the ids, not for the char-level conversion itself
+        import numpy as np
+        ids = np.frombuffer(self.ids, dtype=np.int32)
+        if not self.fixed:
+            # Ids were given in order of appearance, sort by frequency and map the ids to the sorted vocab
+            sorted_tokens = self.special_tokens + [tok for tok, _ in self.counts.most_common()]
+            new_ids = np.empty(len(sorted_tokens), dtype=np.int32)
+            new_ids[[self.vocab[tok] for tok in sorted_tokens]] = np.arange(len(sorted_tokens), dtype=np.int32)
+            ids = new_ids[ids]
+            write_to_file(['{0}\t{1}'.format(tok, self.counts[tok]) for tok in sorted_tokens], out_file + '.vocab')
+        if write_ids:
+            np.save(out_file + '.ids.npy', ids)
+            np.save(out_file + '.offsets.npy', np.frombuffer(self.offsets, dtype=np.int64))
+
+
+def load_vocab(vocab_file):
+    '''Load a vocab file with a token (and possibly its frequency) per line, the id of a token is its line number'''
+    vocab = {}
+    for line in open(vocab_file, 'r'):
+        if line.strip():
+            vocab.setdefault(line.split()[0], len(vocab))
+    # Tokens that are not in the vocab get the id of <unk>, add it if the vocab does not have it
+    vocab.setdefault(VocabIds.special_tokens[1], len(vocab))
+    return vocab
+
+
+def build_vocab(char_files, vocab_file):
+    '''Write a single frequency-sorted vocab for the tokens of all char_files, so that they share their ids'''
+    counts = Counter()
+    for char_file in char_files:
+        for line in open(char_file, 'r', newline='\n'):
+            counts.update(line.split())
+    sorted_tokens = VocabIds.special_tokens + [tok for tok, _ in counts.most_common() if tok not in VocabIds.special_tokens]
+    write_to_file(['{0}\t{1}'.format(tok, counts[tok]) for tok in sorted_tokens], vocab_file)
+
+
+def write_ids(char_file, vocab_file):
+    '''Write the token ids of an existing char-level file with the tokens of vocab_file'''
+    vocab_ids = VocabIds(vocab_file)
+    for line in open(char_file, 'r', newline='\n'):
+        vocab_ids.add(line)
+    vocab_ids.save(char_file, True)
+    vocab_ids.print_oov()
+
+
+def char_level_lines(input_file, out_file, mode, coreference, threads=1, vocab_ids=None):
+    '''Stream the lines of input_file in char-level format to out_file, mode is chars, super or pos
+       Large files are divided over multiple processes (output order stays the same)
+       If vocab_ids is given, the tokens of the output lines are added to it as well'''
+    # Only split on \n when putting all characters in char-level, carriage returns are normal characters then
+    in_f = open(input_file, 'r', newline='\n' if mode == 'chars' else None)
+    lines = ([line, mode, coreference] for line in in_f)
+    batch_size = 10000 * threads
+    pool = None
+    with open(out_file, 'w') as out_f:
+        for batch in iter(lambda: list(islice(lines, batch_size)), []):
+            # Only start processes if the file does not fit in a single batch
+            if not pool and threads > 1 and len(batch) == batch_size:
+                pool = Pool(processes=threads)
+            new_lines = pool.imap(encode_line, batch, chunksize=500) if pool else map(encode_line, batch)
+            if vocab_ids is not None:
+                new_lines = list(new_lines)
+                for new_line in new_lines:
+                    vocab_ids.add(new_line)
+            out_f.writelines(new_lines)
+    in_f.close()
+    if pool:
+        pool.close()
+
+
+def char_level_file(input_file, amr_ext, sent_ext, pos, super_chars, coreference, round_trip=False, ids=False, vocab_amr='', vocab_sent='', sort_length=0, threads=1):
+    '''Given an input file, put it in char-level format and write output
+       With round_trip we check that the output decodes to the input again (not possible for POS-tagged files)
+       With ids (or an existing vocab) we also collect the token ids of the output in the same pass
+       With sort_length we also write a copy sorted by length for batched decoding, postprocess_AMRs.py -or restores the order'''
     if input_file.endswith(amr_ext):
         # File ends with AMR extension, do AMR char-level processing
         out_f = input_file.replace(amr_ext, '.char' + amr_ext)
+        vocab_file = vocab_amr
 
         if super_chars:
             # Super characters get a different treatment
             print('AMR file, super characters')
-            amr_lines = get_amr_lines(input_file)
-            fixed_lines = get_fixed_lines(amr_lines, coreference)
-            write_to_file(fixed_lines, out_f)
+            mode = 'super'
         else:
             print('AMR file, no super characters')
-            # If there are no super character we can just process with sed
-            os_call = 'sed -e "s/\ /+/g"  -e "s/./&\ /g" < {0} > {1}'.format(input_file, out_f)
-            os.system(os_call)
+            mode = 'chars'
+        codec = CharCodec(super_chars, coreference)
 
     elif input_file.endswith(sent_ext):
         # File ends with sent ext, do sentence processing
         out_f = input_file.replace(sent_ext, '.char' + sent_ext)
+        vocab_file = vocab_sent
         if pos:
             # POS-tagged files get a different treatment
             print('Sentence file, POS-tagged')
-            lines = process_pos_tagged(input_file)
-            write_to_file(lines, out_f)
+            mode = 'pos'
+            codec = None
         else:
-            # Not POS-tagged, so we can just use sed
             print('Sentence file, not POS-tagged')
-            os_call = 'sed -e "s/\ /+/g"  -e "s/./&\ /g" < {0} > {1}'.format(input_file, out_f)
-            os.system(os_call)
+            mode = 'chars'
+            codec = CharCodec(amr=False)
+    else:
+        return
+
+    vocab_ids = VocabIds(vocab_file) if ids or vocab_file else None
+    char_level_lines(input_file, out_f, mode, coreference, threads, vocab_ids)
+    if vocab_ids is not None:
+        vocab_ids.save(out_f, ids)
+        if vocab_file:
+            vocab_ids.print_oov()
+    if round_trip and codec and check_round_trip(input_file, out_f, codec):
+        raise ValueError('{0} does not round-trip, see the lines above'.format(out_f))
+    if sort_length:
+        sort_by_length(out_f, out_f + '.sorted', out_f + '.order', sort_length)
+
 
 if __name__ == '__main__':
     args = create_arg_parser()
 
     if not args.folder:
         # Do a single file
-        char_level_file(args.input_file, args.amr_ext, args.sent_ext, args.pos, args.super_chars, args.coreference)
+        char_level_file(args.input_file, args.amr_ext, args.sent_ext, args.pos, args.super_chars, args.coreference, args.round_trip, args.ids, args.vocab_amr, args.vocab_sent, args.sort_length, args.threads)
     else:
-        # Do all files in a folder with certain extension
-        for root, dirs, files in os.walk(args.input_file):
-            for f in files:
-                if f.endswith(args.amr_ext) or f.endswith(args.sent_ext):
-                    char_level_file(os.path.join(root, f), args.amr_ext, args.sent_ext, args.pos, args.super_chars, args.coreference)
+        # Do all files in a folder with certain extension, files are processed in parallel so the lines within a file are not
+        # With -ids the files need the same vocab: first write all char-level files, then the ids of all of them
+        vocabs = ['', ''] if args.ids else [args.vocab_amr, args.vocab_sent]
+        process_folder(args.input_file, (args.amr_ext, args.sent_ext), char_level_file, [args.amr_ext, args.sent_ext, args.pos, args.super_chars, args.coreference, args.round_trip, False] + vocabs + [args.sort_length], args.threads)
+        if args.ids:
+            for ext, vocab_file in [(args.amr_ext, args.vocab_amr), (args.sent_ext, args.vocab_sent)]:
+                char_files = sorted(get_files_by_ext(args.input_file, '.char' + ext))
+                # Without an existing vocab, build a single one for the whole folder (e.g. char.tf.vocab)
+                if not vocab_file and char_files:
+                    vocab_file = os.path.join(args.input_file, 'char' + ext + '.vocab')
+                    build_vocab(char_files, vocab_file)
+                    print('Wrote a shared vocab for {0} files to {1}'.format(len(char_files), vocab_file))
+                for char_file in char_files:
+                    write_ids(char_file, vocab_file)
 
@@ -20,9 +20,9 @@ Sample output *.tf:
 
 import sys
 import argparse
-import os
-from amr_utils import write_to_file, space_brackets_amr, reverse_tokenize, variable_match
-from var_free_amrs import delete_wiki, single_line_convert
+from collections import Counter
+from amr_utils import write_to_file, space_brackets_amr, reverse_tokenize, variable_match, process_folder
+from var_free_amrs import delete_wiki_line, iter_single_line_amrs
 
 
 def create_arg_parser():
@@ -32,62 +32,51 @@ def create_arg_parser():
     parser.add_argument('-a', '--amr_ext', default='.txt', help="Extension of AMR files (default .txt, only necessary when doing folder")
     parser.add_argument('-o', '--output_ext', default='.tf', help="Extension of output AMR files (default .tf)")
     parser.add_argument('-k', '--keep_wiki', action='store_true', help='Keep Wiki link when processing')
+    parser.add_argument('-t', '--threads', default=16, type=int, help="Number of files processed in parallel when using -fol (default 16)")
     args = parser.parse_args()
     return args
 
 
 def coreference_index(one_line_amrs):
     '''Function that replaces coreference entities by its relative or absolute path'''
-    new_amrs = []
-    # Tokenize AMRs
-    amrs = [space_brackets_amr(x).split() for x in one_line_amrs]
+    return [coreference_index_line(line) for line in one_line_amrs]
+
+
+def coreference_index_line(line):
+    '''Replace the variables of a single one-line AMR by an index if they are re-entrant, remove them otherwise'''
     # We always skip stuff such as :mode interrogative as possible variables
     no_var_list = ['interrogative', 'expressive', 'imperative']
-
-    # Loop over AMRs
-    for spl in amrs:
-        all_vars = []
-        # Loop over all tokens in AMR and save variables
-        for idx in range(0, len(spl)):
-            # Check if entity looks like a coreference variable
-            if variable_match(spl, idx, no_var_list):
-                all_vars.append(spl[idx])
-
-        vars_seen, new_spl = [], []
-        # Loop over tokens again and check if we want to rewrite variables
-        for idx in range(0, len(spl)):
-            if variable_match(spl, idx, no_var_list):
-                # If entity occurs at least twice, make mention of it
-                if all_vars.count(spl[idx]) > 1:
-                    if spl[idx] in vars_seen:
-                        # Already saw the variable, add index path
-                        new_spl.append('*{0}*'.format(vars_seen.index(spl[idx])))
-                    else:
-                        # Did not see variable before, add new one
-                        new_spl.append('*{0}*'.format(len(vars_seen)))
-                        vars_seen.append(spl[idx])
-            # Skip items that were part of a variable (not there anymore)
-            elif spl[idx] != '/':
-                new_spl.append(spl[idx])
-
-        # Reverse tokenize and save AMRs
-        new_line = " ".join(new_spl)
-        new_line = reverse_tokenize(new_line)
-        new_amrs.append(new_line)
-
-    # Sanity check
-    assert len(amrs) == len(new_amrs)
-    return new_amrs
+    spl = space_brackets_amr(line).split()
+
+    # Save which tokens are variables and count how often each variable occurs
+    is_var = [variable_match(spl, idx, no_var_list) for idx in range(len(spl))]
+    var_counts = Counter(tok for tok, var in zip(spl, is_var) if var)
+
+    # Loop over tokens again and check if we want to rewrite variables
+    var_index, new_spl = {}, []
+    for tok, var in zip(spl, is_var):
+        if var:
+            # If entity occurs at least twice, make mention of it
+            if var_counts[tok] > 1:
+                # Variables get a new index the first time we see them
+                if tok not in var_index:
+                    var_index[tok] = len(var_index)
+                new_spl.append('*{0}*'.format(var_index[tok]))
+        # Skip items that were part of a variable (not there anymore)
+        elif tok != '/':
+            new_spl.append(tok)
+
+    # Reverse tokenize and return the AMR
+    return reverse_tokenize(" ".join(new_spl))
 
 
 def create_coref_indexing(input_file, output_ext, keep_wiki):
-    '''Go from full AMR to one-line AMR without wiki with coreference indexed'''
+    '''Go from full AMR to one-line AMR without wiki with coreference indexed
+       The AMRs are streamed from the input file to the output file'''
     # Remove all Wiki instances
-    amr_file_no_wiki = delete_wiki(input_file) if not keep_wiki else [x.rstrip() for x in open(input_file, 'r')]
-    # Put everything on a single line, sent_file is empty
-    single_amrs, _ = single_line_convert(amr_file_no_wiki, '')
-    # Add the coference index we want
-    repl_amrs = coreference_index(single_amrs)
+    lines = (delete_wiki_line(x) for x in open(input_file, 'r')) if not keep_wiki else (x.rstrip() for x in open(input_file, 'r'))
+    # Put everything on a single line and add the coference index we want
+    repl_amrs = (coreference_index_line(line) for line in iter_single_line_amrs(lines))
     # Write output to file
     write_to_file(repl_amrs, input_file + output_ext)
 
@@ -99,10 +88,7 @@ if __name__ == "__main__":
     if not args.folder:
         create_coref_indexing(args.input_file, args.output_ext, args.keep_wiki)
     else:
-        for root, dirs, files in os.walk(args.input_file):
-            for f in files:
-                if f.endswith(args.amr_ext):
-                    create_coref_indexing(os.path.join(root, f), args.output_ext, args.keep_wiki)
+        process_folder(args.input_file, args.amr_ext, create_coref_indexing, [args.output_ext, args.keep_wiki], args.threads)
 
 
 
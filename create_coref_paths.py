@@ -2,9 +2,12 @@
 # -*- coding: utf8 -*-
 
 '''Script that converts the AMRs to a single line, taking care of re-entrancies in a nice way
-   It does this by adding the absolute or relative paths. Currently, only absolute paths are implemented.
+   It does this by adding the absolute or relative paths.
    Method is described in "Dealing with Co-reference in Neural Semantic Parsing", Van Noord and Bos, 2017
 
+   Absolute paths start at the root, relative paths start at the node that contains the reference:
+   each ^ goes up a level, after which the path goes down to the referent
+
   Sample input:
 
    # ::snt Bob likes himself.
@@ -15,13 +18,19 @@
 
    Sample output *.tf:
 
-    (like :ARG0 (person :name "Bob") :ARG1 ( { :ARG0 |1| } ))'''
+    (like :ARG0 (person :name "Bob") :ARG1 ( { :ARG0 |1| } ))
+
+   Sample output *.tf with relative paths (-p rel):
+
+    (like :ARG0 (person :name "Bob") :ARG1 ( { :ARG0 |1| } ))
+
+   Deeper in the AMR the paths differ: a reference in the node at :ARG1 |1| :ARG1 |1| to the referent at
+   :ARG1 |1| :ARG0 |1| gets the absolute path { :ARG1 |1| :ARG0 |1| } but the relative path { ^ :ARG0 |1| }'''
 
 import sys
 import re
 import argparse
-import os
-from amr_utils import write_to_file, space_brackets_amr, reverse_tokenize, between_quotes, left_space_for_char, add_to_dict
+from amr_utils import write_to_file, space_brackets_amr, reverse_tokenize, between_quotes, left_space_for_char, process_folder
 from var_free_amrs import delete_wiki, single_line_convert
 
 
@@ -32,14 +41,15 @@ def create_arg_parser():
     parser.add_argument('-fol', '--folder', action='store_true', help='Add to do multiple files in a folder - if not, -f is a file')
     parser.add_argument('-a', '--amr_ext', default='.txt', help="extension of AMR files (default .txt, only necessary when doing folder")
     parser.add_argument('-o', '--output_ext', default='.tf', help="extension of output AMR files (default .tf)")
-    parser.add_argument('-p', "--path", required=True, choices=['rel', 'abs'], help='Add relative or absolute path (only abs implemented)')
+    parser.add_argument('-p', "--path", required=True, choices=['rel', 'abs'], help='Add relative or absolute path')
     parser.add_argument('-k', '--keep_wiki', action='store_true', help='Keep Wiki link when processing')
     parser.add_argument('-ps', '--print_stats', action='store_true', help='Print coreference statistics')
+    parser.add_argument('-t', '--threads', default=16, type=int, help="Number of files processed in parallel when using -fol (default 16)")
     args = parser.parse_args()
     return args
 
 
-def replace_coreference(one_line_amrs, print_stats):
+def replace_coreference(one_line_amrs, path_type, print_stats):
     '''Function that replaces coreference entities by its relative or absolute path
        Also normalizes the input, references to variables can not be before instantiation'''
     new_amrs = []
@@ -56,9 +66,10 @@ def replace_coreference(one_line_amrs, print_stats):
         # Find the path for each variable, save in dict
         var_dict = get_var_dict(spl)
         cur_path = []
-        all_paths = []
+        path_counts = {}
         new_spl = []
-        vars_seen = []
+        # Variables of the nodes we are currently in, the root is skipped in the loop so add it here
+        open_vars = [spl[1]] if len(spl) > 1 else []
         level, previous_close = 0, False
         # Loop over all tokens in AMR
         # Skip first parenthesis to make things easier, add later
@@ -71,16 +82,18 @@ def replace_coreference(one_line_amrs, print_stats):
                 continue
 
             # Check if entity looks like a coreference variable
-            var_check, vars_seen = variable_match(spl, idx, no_var_list, vars_seen)
+            var_check = variable_match(spl, idx, no_var_list)
 
             # Opening parenthesis, means we have to add the previous argument to our path
             if spl[idx] == '(':
                 level += 1
-                cur_path, all_paths = find_cur_path_addition(cur_path, spl, idx, all_paths)
+                cur_path = find_cur_path_addition(cur_path, spl, idx, path_counts)
+                open_vars.append(spl[idx+1])
                 previous_close = False
             # Closing, decrease level by 1
             elif spl[idx] == ')':
                 level -= 1
+                open_vars = open_vars[:-1]
                 previous_close = True
             # We previously saw a closing parenthesis, means we have finished the last part of our path
             elif previous_close:
@@ -92,7 +105,8 @@ def replace_coreference(one_line_amrs, print_stats):
                 if not (spl[idx].startswith(':') or spl[idx].startswith('"')):
                     if spl[idx] in var_dict:
                         # Found variable, check paths here
-                        path_dict, all_paths, new_spl, _ = add_path_to_amr(spl, idx, var_dict, cur_path, count, path_dict, all_paths, new_spl, coref_amrs)
+                        parent_var = open_vars[-1] if open_vars else spl[1]
+                        path_dict, new_spl, _ = add_path_to_amr(spl, idx, var_dict, cur_path, count, path_dict, path_counts, new_spl, coref_amrs, path_type, parent_var)
             # We saw a non-interesting entity, just continue
             else:
                 previous_close = False
@@ -106,7 +120,7 @@ def replace_coreference(one_line_amrs, print_stats):
     assert len(amrs) == len(new_amrs)
     # Print some stats
     if print_stats:
-        print_coref_stats(coref_amrs, path_dict)
+        print_coref_stats(coref_amrs, path_dict, path_type)
     return new_amrs
 
 
@@ -115,7 +129,7 @@ def get_var_dict(spl):
 
     cur_path = []
     level = 0
-    all_paths = []
+    path_counts = {}
     var_dict = dict()
     previous_close = False
 
@@ -123,7 +137,7 @@ def get_var_dict(spl):
     for idx in range(1, len(spl)):
         if spl[idx] == '(':
             level += 1
-            cur_path, all_paths = find_cur_path_addition(cur_path, spl, idx, all_paths)
+            cur_path = find_cur_path_addition(cur_path, spl, idx, path_counts)
             previous_close = False
         elif spl[idx] == ')':
             level -= 1
@@ -143,40 +157,21 @@ def get_var_dict(spl):
     return var_dict
 
 
-def variable_match(spl, idx, no_var_list, vars_seen):
+def variable_match(spl, idx, no_var_list):
     '''Function that matches entities that are variables'''
     if spl[idx+1] == '/':
-        vars_seen.append(spl[idx])
-        return False, vars_seen
-    elif spl[idx-1] != '/' and any(char.isalpha() for char in spl[idx]) and spl[idx] not in no_var_list and not between_quotes(spl[idx]) and not spl[idx].startswith(':'):
-        return True, vars_seen
-    else:
-        return False, vars_seen
-
-
-def find_cur_path_addition(cur_path, spl, idx, all_paths):
-    '''Function that finds what we have to add to our current path'''
-    counter = 1
-    found_before = False
-    for c in range(15, 1, -1):
-        # If there are multiple occurences, add the next one (2,3,4,5 etc)
-        to_add = "".join(cur_path) + spl[idx-1] + '|{0}|'.format(c)
-        if to_add in all_paths:
-            counter = c
-            found_before = True
-            break
-        prev_add = to_add
+        return False
+    return spl[idx-1] != '/' and any(char.isalpha() for char in spl[idx]) and spl[idx] not in no_var_list and not between_quotes(spl[idx]) and not spl[idx].startswith(':')
 
-    if not found_before:
-        counter = 1
 
+def find_cur_path_addition(cur_path, spl, idx, path_counts):
+    '''Function that finds what we have to add to our current path
+       path_counts keeps how often each relation occurred already for each path prefix'''
+    key = ("".join(cur_path), spl[idx-1])
+    counter = path_counts.get(key, 0) + 1
+    path_counts[key] = counter
     cur_path.append(spl[idx-1] + '|{0}|'.format(counter))
-    all_paths.append(prev_add)
-
-    if len(all_paths) != len(set(all_paths)):
-        print('Something is wrong')
-
-    return cur_path, all_paths
+    return cur_path
 
 
 def remove_variables(amrs):
@@ -193,36 +188,65 @@ def remove_variables(amrs):
     return new_amrs
 
 
-def add_path_to_amr(spl, idx, var_dict, cur_path, count, path_dict, all_paths, new_spl, coref_amrs):
-    '''Function that finds the path that needs to be added and adds it'''
+def add_path_to_amr(spl, idx, var_dict, cur_path, count, path_dict, path_counts, new_spl, coref_amrs, path_type, parent_var):
+    '''Function that finds the path that needs to be added and adds it
+       path_dict keeps for each added path how often it occurred and the total length of the absolute paths'''
     # We skipped this part of the path because it doesn't start with a parenthesis, still add it here
     if spl[idx-1].startswith(':'):
-        cur_path, all_paths = find_cur_path_addition(cur_path, spl, idx, all_paths)
+        cur_path = find_cur_path_addition(cur_path, spl, idx, path_counts)
 
-    if args.path == 'rel':
-        raise NotImplementedError("Relative paths are not implemented yet")
+    abs_path = var_dict[spl[idx]][1]
+    if path_type == 'rel':
+        add_path = get_relative_path(var_dict[parent_var][1], abs_path)
     else:
         # Add absolute path here
-        new_spl[-1] = '{ ' + var_dict[spl[idx]][1]  + ' }'
-        add_path = var_dict[spl[idx]][1]
+        add_path = abs_path
+    new_spl[-1] = '{ ' + add_path + ' }'
+
+    # Check if we already added this AMR
+    if not coref_amrs or coref_amrs[-1] != count:
+        coref_amrs.append(count)
+    if add_path not in path_dict:
+        path_dict[add_path] = [0, 0, 0]
+    path_dict[add_path][0] += 1
+    path_dict[add_path][1] += len(abs_path.split())
+    path_dict[add_path][2] += path_char_length(abs_path)
+    return path_dict, new_spl, add_path
+
+
+def get_relative_path(parent_path, abs_path):
+    '''Get the relative path from the node that contains the reference (with absolute path parent_path) to the
+       referent: go up (^) to the deepest common node, then follow the rest of the absolute path down'''
+    parent_steps, steps = parent_path.split(), abs_path.split()
+    common = 0
+    while common < min(len(parent_steps), len(steps)) and parent_steps[common] == steps[common]:
+        common += 1
+    return " ".join(['^'] * (len(parent_steps) - common) + steps[common:])
+
 
-        # Check if we already added this AMR
-        if not coref_amrs or coref_amrs[-1] != count:
-            coref_amrs.append(count)
-        path_dict = add_to_dict(path_dict, add_path, 1)
-    return path_dict, all_paths, new_spl, add_path
+def path_char_length(path):
+    '''Length of a path in char-level output: every character is a token, spaces become +
+       remove_variables still puts a space between each relation and its |n| counter'''
+    return len(path) + sum(1 for step in path.split() if step != '^')
 
 
-def print_coref_stats(coref_amrs, path_dict):
+def print_coref_stats(coref_amrs, path_dict, path_type):
     '''Print interesting statistics about coref parsing'''
     print('Length of AMRs with coref: {0}'.format(len(coref_amrs)))
     total, once, max_len = 0, 0, 0
+    num_refs, path_len, abs_len, path_chars, abs_chars = 0, 0, 0, 0, 0
 
     # Check in the path dictionary
     for key in path_dict:
         total += 1
-        if path_dict[key] == 1:
+        if path_dict[key][0] == 1:
             once += 1
+        # Number of path tokens compared to the absolute paths
+        num_refs += path_dict[key][0]
+        path_len += path_dict[key][0] * len(key.split())
+        abs_len += path_dict[key][1]
+        path_chars += path_dict[key][0] * path_char_length(key)
+        abs_chars += path_dict[key][2]
 
         if len(key.split()) > max_len:
             max_len = len(key.split())
@@ -232,16 +256,22 @@ def print_coref_stats(coref_amrs, path_dict):
     if max_len > 0:
         print('Longest path: {0}\nOf length: {1}\n'.format(long_path, max_len))
     print('{0} out of {1} are unique'.format(once, total))
+    if num_refs > 0:
+        print('Average path length of {0} references: {1:.2f} tokens'.format(num_refs, path_len / float(num_refs)))
+    # Compare the sequence length of relative paths with absolute paths, the char-level length is what the model outputs
+    if path_type == 'rel' and abs_len > 0:
+        print('Path tokens: {0} for rel paths, {1} for abs paths ({2:.1f}%)'.format(path_len, abs_len, 100.0 * path_len / abs_len))
+        print('Path chars: {0} for rel paths, {1} for abs paths ({2:.1f}%)'.format(path_chars, abs_chars, 100.0 * path_chars / abs_chars))
 
 
-def create_coref_paths(input_file, output_ext, keep_wiki, print_stats):
+def create_coref_paths(input_file, output_ext, path_type, keep_wiki, print_stats):
     '''Main function to create the coreference paths'''
     # Delete wiki links only if we want to
     amr_file_no_wiki = delete_wiki(input_file) if not keep_wiki else [x.rstrip() for x in open(input_file, 'r')]
     # Put the AMRs on a single line
     single_amrs, _ = single_line_convert(amr_file_no_wiki, '')
     # Replace coreference with paths of our choice
-    repl_amrs = replace_coreference(single_amrs, print_stats)
+    repl_amrs = replace_coreference(single_amrs, path_type, print_stats)
     final_amrs = remove_variables(repl_amrs)
     # Write final AMRs to a file
     write_to_file(final_amrs, input_file + output_ext)
@@ -252,10 +282,7 @@ if __name__ == "__main__":
 
     # Either do a single file or loop over files in folder
     if not args.folder:
-        create_coref_paths(args.input_file, args.output_ext, args.keep_wiki, args.print_stats)
+        create_coref_paths(args.input_file, args.output_ext, args.path, args.keep_wiki, args.print_stats)
     else:
-        for root, dirs, files in os.walk(args.input_file):
-            for f in files:
-                if f.endswith(args.amr_ext):
-                    create_coref_paths(os.path.join(root, f), args.output_ext, args.keep_wiki, args.print_stats)
+        process_folder(args.input_file, args.amr_ext, create_coref_paths, [args.output_ext, args.path, args.keep_wiki, args.print_stats], args.threads)
 
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+'''Script that (re)builds the reference dict used when restoring coreference (restoreAMR/ref_dict)
+   For each concept it counts how often it is the target of a re-entrancy in the training AMRs
+
+   The AMRs are streamed and counted in chunks over multiple processes (map), after which the counts are summed (reduce).
+   The output is a compact JSON dict that can be loaded by amr_utils.load_dict
+
+   Sample input:
+
+   (l / like
+        :ARG0 (p / person :name "Bob")
+        :ARG1 p)
+
+   Output: {"person":1}'''
+
+import sys
+import argparse
+import json
+from itertools import islice
+from collections import Counter
+from multiprocessing import Pool
+from amr_utils import stream_amrs, get_files_by_ext, parse_amr_tree, AMRNode
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--input_file', required=True, type=str, help="File or folder with AMRs")
+    parser.add_argument('-fol', '--folder', action='store_true', help='Add to do multiple files in a folder - if not, args.f is a file')
+    parser.add_argument('-a', '--amr_ext', default='.txt', help="Extension of AMR files (default .txt, only necessary when doing folder")
+    parser.add_argument('-o', '--output_file', default='restoreAMR/ref_dict', help="Output file (default restoreAMR/ref_dict)")
+    parser.add_argument('-t', '--threads', default=16, type=int, help="Number of parallel processes (default 16)")
+    parser.add_argument('-c', '--chunk_size', default=1000, type=int, help="Number of AMRs per chunk that is sent to a process (default 1000)")
+    parser.add_argument('-m', '--min_count', default=1, type=int, help="Only keep concepts that are re-entrant at least this often (default 1)")
+    args = parser.parse_args()
+    return args
+
+
+def collect_nodes(node, var_dict, references):
+    '''Save the concept of each variable and all variables that are used as a value (re-entrancies)'''
+    var_dict[node.var] = node.concept
+    for _, child in node.children:
+        if isinstance(child, AMRNode):
+            collect_nodes(child, var_dict, references)
+        else:
+            references.append(child)
+
+
+def count_reentrancies(amrs):
+    '''Map step: count the concepts that are re-entrancy targets for a chunk of one-line AMRs'''
+    counts = Counter()
+    for amr in amrs:
+        try:
+            root = parse_amr_tree(amr)
+        except ValueError:
+            continue
+        var_dict, references = {}, []
+        collect_nodes(root, var_dict, references)
+        # Values that are not variables are constants (numbers, strings, -)
+        counts.update(var_dict[ref] for ref in references if ref in var_dict)
+    return counts
+
+
+def chunk_amrs(input_files, chunk_size):
+    '''Stream the AMRs of all input files in chunks of chunk_size AMRs'''
+    for input_file in input_files:
+        amrs = stream_amrs(input_file)
+        chunk = list(islice(amrs, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = list(islice(amrs, chunk_size))
+
+
+def build_ref_dict(input_files, threads, chunk_size):
+    '''Count re-entrancy targets in parallel over chunks and merge the counts'''
+    total = Counter()
+    pool = Pool(processes=threads)
+    for counts in pool.imap_unordered(count_reentrancies, chunk_amrs(input_files, chunk_size)):
+        total.update(counts)
+    pool.close()
+    return total
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    input_files = sorted(get_files_by_ext(args.input_file, args.amr_ext)) if args.folder else [args.input_file]
+    ref_counts = build_ref_dict(input_files, args.threads, args.chunk_size)
+    # Most frequent first, without whitespace so the file is small and quick to load
+    ref_dict = {concept: count for concept, count in ref_counts.most_common() if count >= args.min_count}
+    with open(args.output_file, 'w') as out_f:
+        json.dump(ref_dict, out_f, separators=(',', ':'))
+    print('Wrote {0} concepts to {1}'.format(len(ref_dict), args.output_file))
@@ -3,7 +3,8 @@
 
 '''Script that tests given seq2seq model on given test data, also restoring and wikifying the produced AMRs
 
-Input should either be a produced AMR -file or a folder to traverse. Outputs .restore, .pruned, .coref and .all files'''
+Input should either be a produced AMR -file, a folder to traverse or the shard map of shards made by shard_AMRs.py.
+Outputs .restore, .pruned, .coref and .all files'''
 
 
 import sys
@@ -11,8 +12,10 @@ import re
 import argparse
 import os
 from multiprocessing import Pool
-from amr_utils import get_default_amr, valid_amr
+from amr_utils import get_default_amr, valid_amr, restore_order
+import prune_amrs
 import wikify_file
+from shard_AMRs import split_name, shard_name, read_shard_map, read_shard_exts, merge_shards
 
 
 def create_arg_parser():
@@ -22,13 +25,18 @@ def create_arg_parser():
     parser.add_argument('-f', '--input_file', required=True, help="File or folder to be post-processed")
     parser.add_argument('-s', '--sentence_file', default='', help="Sentence file or folder, only necessary for Wikification")
     parser.add_argument('-fol', '--folder', action='store_true', help="Whether -f is a folder")
-    parser.add_argument('-se', '--sent_ext', default='.sent', help="Sentence extension - only necessary when doing folder (default .sent)")
-    parser.add_argument('-o', '--out_ext', default='.seq.amr', help="Output extension - only necessary when doing folder (default .seq.amr)")
+    parser.add_argument('-sh', '--shards', action='store_true', help="Whether -f is a shard map made by shard_AMRs.py, the shards are processed in parallel and the .final files are merged in the original order")
+    parser.add_argument('-se', '--sent_ext', default='.sent', help="Sentence extension - only necessary when doing folder or shards (default .sent)")
+    parser.add_argument('-o', '--out_ext', default='.seq.amr', help="Output extension - only necessary when doing folder or shards (default .seq.amr)")
     parser.add_argument('-t', '--threads', default=16, type=int, help="Maximum number of parallel threads")
-    parser.add_argument('-c', '--coreference', default='dupl', choices=['dupl', 'index', 'abs'], help='How to handle coreference - input was either duplicated/indexed/absolute path (default dupl)')
+    parser.add_argument('-c', '--coreference', default='dupl', choices=['dupl', 'index', 'abs', 'rel'], help='How to handle coreference - input was either duplicated/indexed/absolute path/relative path (default dupl)')
     parser.add_argument('-n', '--no_wiki', action='store_true', help='Not doing Wikification, since it takes a long time sometimes we want to skip it')
+    parser.add_argument('-nb', '--n_best', default=1, type=int, help='Number of hypotheses per sentence in the decoder output, the first valid one is kept (default 1)')
+    parser.add_argument('-or', '--order', default='', help='Order file of char_level_AMR.py -sl if the model decoded the sorted copy, the AMRs are put back in the original order after restoring (single file only)')
     parser.add_argument('-fo', '--force', action='store_true', help='For reprocessing of file even if file already exists')
     args = parser.parse_args()
+    if args.order and (args.folder or args.shards):
+        parser.error('-or only works for a single file')
     return args
 
 
@@ -96,18 +104,23 @@ def do_pruning(in_file, force):
     # Only prune if output file doesn't already exist
     if not os.path.isfile(prune_file) or force:
         # Do pruning here
-        os.system('python3 prune_amrs.py -f {0}'.format(in_file))
+        prune_amrs.prune_file(in_file)
         # Check if they're still all valid
         check_valid(prune_file, True)
     return prune_file
 
 
-def restore_amr(in_file, out_file, coref_type, force):
+def restore_amr(in_file, out_file, coref_type, n_best, force, order_file=''):
     '''Function that restores variables in output AMR
-       Also restores coreference for index/absolute paths methods'''
+       Also restores coreference for index/absolute paths methods
+       For n-best output the first valid hypothesis per sentence is kept
+       If the input was sorted by length, the AMRs are put back in the original order, so the next steps
+       (including Wikification) see the AMRs in the order of the sentence file'''
     if not os.path.isfile(out_file) or force:
-        restore_call = 'python3 restoreAMR/restore_amr.py -f {0} -o {1} -c {2}'.format(in_file, out_file, coref_type)
+        restore_call = 'python3 restoreAMR/restore_amr.py -f {0} -o {1} -c {2} -n {3}'.format(in_file, out_file, coref_type, n_best)
         os.system(restore_call)
+        if order_file:
+            restore_order(out_file, order_file)
         check_valid(out_file, True)
     return out_file
 
@@ -115,7 +128,7 @@ def restore_amr(in_file, out_file, coref_type, force):
 def process_file(input_list):
     '''Postproces AMR file'''
     # Unpack arguments
-    input_file, sent_file, no_wiki, coreference, force = input_list
+    input_file, sent_file, no_wiki, coreference, n_best, force, order_file = input_list
 
     # Sanity check first
     if (not os.path.isfile(sent_file) and not no_wiki) or not os.path.isfile(input_file) or not os.path.getsize(input_file):
@@ -123,7 +136,7 @@ def process_file(input_list):
 
     # Restore AMR first (variables)
     restore_file = input_file + '.restore'
-    restore_file = restore_amr(input_file, restore_file, coreference, force)
+    restore_file = restore_amr(input_file, restore_file, coreference, n_best, force, order_file)
 
     # Then do all postprocessing steps separately so we can see the individual impact of them
     # We always do pruning
@@ -160,7 +173,7 @@ def process_file(input_list):
         raise ValueError('Wikification failed, consider using --no_wiki')
 
 
-def match_files_by_name(amr_files, sent_files, no_wiki, coreference, force):
+def match_files_by_name(amr_files, sent_files, no_wiki, coreference, n_best, force):
     '''Input is a list of both amr and sentence files, return matching pairs to test in parallel in the main function'''
     matches = []
     for amr in amr_files:
@@ -170,7 +183,7 @@ def match_files_by_name(amr_files, sent_files, no_wiki, coreference, force):
             match_sent = sent.split('/')[-1].split('.')[0]
             # Matching sentence and AMR file, we can process those, so save them
             if match_sent == match_amr:
-                matches.append([amr, sent, no_wiki, coreference, force])
+                matches.append([amr, sent, no_wiki, coreference, n_best, force, ''])
                 break
     return matches
 
@@ -186,14 +199,26 @@ def get_files(folder, ext):
 
 if __name__ == "__main__":
     args = create_arg_parser()
-    if not args.folder:
+    if args.shards:
+        # Output and sentence files of the shards are named after the shard map, see shard_AMRs.py
+        # The sentence shards have the extension of the parallel file that ends with -se, e.g. .txt.sent
+        base, _ = split_name(args.input_file)
+        sent_ext = next((ext for ext in read_shard_exts(args.input_file)[1:] if ext.endswith(args.sent_ext)), args.sent_ext)
+        shard_files = [[shard_name(base, shard, args.out_ext), shard_name(base, shard, sent_ext), args.no_wiki, args.coreference, args.n_best, args.force, '']
+                       for shard in sorted(set(read_shard_map(args.input_file)))]
+        print(('Processing {0} shards, doing max {1} in parallel'.format(len(shard_files), args.threads)))
+        pool = Pool(processes=args.threads)
+        pool.map(process_file, shard_files)
+        pool.close()
+        merge_shards(args.input_file, args.out_ext + '.restore.final')
+    elif not args.folder:
         print('Process single file\n')
-        process_file([args.input_file, args.sentence_file, args.no_wiki, args.coreference, args.force])
+        process_file([args.input_file, args.sentence_file, args.no_wiki, args.coreference, args.n_best, args.force, args.order])
     else:
         # Get AMR and sent files and match them
         sent_files = get_files(args.sentence_file, args.sent_ext)
         amr_files = get_files(args.input_file, args.out_ext)
-        matching_files = match_files_by_name(amr_files, sent_files, args.no_wiki, args.coreference, args.force)
+        matching_files = match_files_by_name(amr_files, sent_files, args.no_wiki, args.coreference, args.n_best, args.force)
         print(('Processing {0} files, doing max {1} in parallel'.format(len(matching_files), args.threads)))
         pool = Pool(processes=args.threads)
         pool.map(process_file, matching_files)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+'''Script that creates the training data from AMR files in a single command: each AMR is read once and all steps are done
+   in memory. Does the same as running var_free_amrs.py (or create_coref_indexing.py/create_coref_paths.py), then
+   best_amr_permutation.py and then char_level_AMR.py or subword_AMR.py, but only writes the final files:
+
+   - removing wiki links (unless -k)
+   - coreference: duplicating (dupl), indexing (index) or absolute/relative paths (abs/rel)
+   - optionally put the AMR in the order that best matches the sentence (-r, needs aligned AMRs or -l, only for dupl)
+   - representation: word-level, char-level, char-level with super characters or subwords (with existing BPE codes)
+
+   Outputs .tf and .sent files (.char.tf and .char.sent for char-level, .bpe.tf and .bpe.sent for subwords),
+   the sentences are taken from the # ::snt (or # ::tok) lines of the AMR file'''
+
+
+import sys
+import argparse
+from itertools import islice
+from multiprocessing import Pool
+from amr_utils import process_folder
+from var_free_amrs import read_amr_blocks, delete_wiki_line, delete_block_variables
+from create_coref_indexing import coreference_index_line
+from create_coref_paths import replace_coreference, remove_variables
+from best_amr_permutation import permute_amr, remove_alignment, add_lexical_alignment
+from char_level_AMR import CharCodec
+from subword_AMR import load_codes, subword_line
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--input_file', required=True, type=str, help="AMR file or folder")
+    parser.add_argument('-fol', '--folder', action='store_true', help='Add to do multiple files in a folder - if not, args.f is a file')
+    parser.add_argument('-a', '--amr_ext', default='.txt', type=str, help="Extension of AMR files (default .txt, only necessary when doing folder)")
+    parser.add_argument('-k', '--keep_wiki', action='store_true', help='Keep Wiki link when processing')
+    parser.add_argument('-c', '--coreference', default='dupl', choices=['dupl', 'index', 'abs', 'rel'], help='How to handle coreference - duplicate/index/absolute path/relative path (default dupl)')
+    parser.add_argument('-r', '--reorder', action='store_true', help='Put the AMR in the order that best matches the word order of the sentence (only for dupl)')
+    parser.add_argument('-l', '--lexical', action='store_true', help="No alignments in input: estimate them by matching concepts to the sentence (for -r)")
+    parser.add_argument('-co', '--cut_off', default=15, type=int, help="When to cut-off number of permutations (for -r, default 15)")
+    parser.add_argument('-rep', '--representation', default='word', choices=['word', 'char', 'super', 'bpe'], help='Word-level, char-level, char-level with super characters or subwords (default word)')
+    parser.add_argument('-b', '--bpe_codes', default='', type=str, help='Existing BPE codes for -rep bpe, see subword_AMR.py')
+    parser.add_argument('-t', '--threads', default=16, type=int, help='Number of processes the AMRs of a file are divided over, or the number of files that are done in parallel when using -fol (default 16)')
+    args = parser.parse_args()
+    if args.reorder and args.coreference != 'dupl':
+        parser.error('-r is only possible with -c dupl, the other methods depend on the order of the AMR')
+    if args.representation == 'bpe' and not args.bpe_codes:
+        parser.error('-rep bpe needs the BPE codes (-b)')
+    return args
+
+
+# Extension of the output files per representation
+out_exts = {'word': '', 'char': '.char', 'super': '.char', 'bpe': '.bpe'}
+# The BPE codes are loaded once per process
+bpe_codes = {}
+
+
+def split_block(block):
+    '''Split a single AMR (list of lines) in its sentence and its AMR lines in one walk over the block
+       The sentence is the first "# ::snt" or "# ::tok" line, as in iter_single_line_amrs'''
+    sent, amr_lines = None, []
+    for line in block:
+        if not line.startswith('#'):
+            amr_lines.append(line)
+        elif sent is None and line.startswith(('# ::snt', '# ::tok')):
+            sent = line[len('# ::snt'):].strip()
+    return sent or '', amr_lines
+
+
+def encode_coreference(amr_lines, coreference):
+    '''Put the lines of a single AMR (without comments and wiki) on a single line without variables,
+       with the chosen coreference method'''
+    if coreference == 'dupl':
+        return " ".join(line.strip() for line in delete_block_variables(amr_lines)).strip()
+    amr = " ".join(line.strip() for line in amr_lines).strip()
+    if coreference == 'index':
+        return coreference_index_line(amr)
+    return remove_variables(replace_coreference([amr], coreference, False))[0]
+
+
+def represent(line, representation, coreference, codes_file, amr=True):
+    '''Put a word-level line in the chosen representation, sentences (amr=False) never get super characters,
+       as in char_level_AMR.py'''
+    if representation in ['char', 'super']:
+        return CharCodec(amr and representation == 'super', coreference, amr).encode(line)
+    elif representation == 'bpe':
+        if codes_file not in bpe_codes:
+            bpe_codes[codes_file] = (load_codes(codes_file), {})
+        ranks, cache = bpe_codes[codes_file]
+        return subword_line(line, ranks, cache)
+    return line
+
+
+def preprocess_amr(input_list):
+    '''Do all preprocessing steps for a single AMR (list of lines), returns the AMR, the sentence and whether the
+       order of the AMR changed, or None if the block had no AMR (only comments)'''
+    block, keep_wiki, coreference, reorder, lexical, cut_off, representation, codes_file = input_list
+    if not keep_wiki:
+        # Lines that only had a wiki link are empty now
+        block = [line for line in map(delete_wiki_line, block) if line.strip()]
+    sent, amr_lines = split_block(block)
+    if not amr_lines:
+        return None
+
+    amr = encode_coreference(amr_lines, coreference)
+    changed = False
+    if reorder:
+        if lexical:
+            amr = add_lexical_alignment(amr, sent)
+        # Only try to do something if we can actually permute
+        new_amr = permute_amr(amr, cut_off) if amr.count(':') > 1 else remove_alignment(amr)
+        changed = new_amr != remove_alignment(amr)
+        amr = new_amr
+    return represent(amr.strip(), representation, coreference != 'dupl', codes_file), represent(sent.strip(), representation, False, codes_file, amr=False), changed
+
+
+def preprocess_file(input_file, keep_wiki, coreference, reorder, lexical, cut_off, representation, codes_file, threads=1):
+    '''Preprocess all AMRs of a file and write the AMRs and sentences, one AMR at a time so memory use does not
+       depend on the file size. With multiple threads the AMRs are divided over the processes (order stays the same)'''
+    blocks = ([block, keep_wiki, coreference, reorder, lexical, cut_off, representation, codes_file] for block in read_amr_blocks(input_file))
+    pool = Pool(processes=threads) if threads > 1 else None
+    num_amrs, num_changed = 0, 0
+    amr_file = input_file + out_exts[representation] + '.tf'
+    sent_file = input_file + out_exts[representation] + '.sent'
+    with open(amr_file, 'w') as amr_f, open(sent_file, 'w') as sent_f:
+        # Hand out a limited number of AMRs at a time, the pool would otherwise read the whole file at once
+        for batch in iter(lambda: list(islice(blocks, 1000 * threads)), []):
+            results = pool.imap(preprocess_amr, batch, chunksize=64) if pool else map(preprocess_amr, batch)
+            for result in results:
+                if result:
+                    amr, sent, changed = result
+                    amr_f.write(amr + '\n')
+                    sent_f.write(sent + '\n')
+                    num_amrs += 1
+                    num_changed += changed
+    if pool:
+        pool.close()
+    print('Wrote {0} AMRs to {1}{2}'.format(num_amrs, amr_file, ', changed the order of {0}'.format(num_changed) if reorder else ''))
+
+
+if __name__ == "__main__":
+    args = create_arg_parser()
+    func_args = [args.keep_wiki, args.coreference, args.reorder, args.lexical, args.cut_off, args.representation, args.bpe_codes]
+
+    if not args.folder:
+        preprocess_file(args.input_file, *func_args, threads=args.threads)
+    else:
+        # Files are processed in parallel, so the AMRs within a file are not
+        process_folder(args.input_file, args.amr_ext, preprocess_file, func_args, args.threads)
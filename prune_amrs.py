@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
 
-'''Script that removes duplicate output from output AMRs. Most code is from best_amr_permutation.py.
+'''Script that removes duplicate output from output AMRs. Works on the parsed AMR, so variables are kept as they are.
     It removes nodes with same argument + concept under the same parent.
     Also removes nodes that occur three times or more, no matter the parent.
 
@@ -16,67 +16,118 @@
     ARG1 - industry node occurs 3 times and therefore gets pruned twice in this example.'''
 
 
-import re
 import sys
 import argparse
-import os
-from amr_utils import count_not_between_quotes, write_to_file
-from best_amr_permutation import get_permutations, get_best_perm, create_final_line
+from collections import Counter
+from amr_utils import write_to_file, parse_amr_tree, amr_tree_to_string, add_subtree_hashes, AMRNode
 
 
 def create_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--input_file", required=True, type=str, help="File with AMRs (one line)")
-    parser.add_argument("-c", "--cut_off", default=15, type=int, help="When to cut-off number of permutations")
     args = parser.parse_args()
     return args
 
 
-def restore_variables(input_file, filtered_amrs):
-    '''Restore the removed variables for the pruned file'''
-    # Write variable-less AMRs to file
-    write_to_file(filtered_amrs, input_file + '.pruned_temp')
-    # Then restore the AMR
-    os.system('python3 restoreAMR/restore_amr.py -f {0} -o {1}'.format(input_file + '.pruned_temp', input_file + '.pruned'))
-    # Remove temp file again
-    os.system("rm {0}".format(input_file + '.pruned_temp'))
-
-
-def prune_file(input_file, cut_off):
-    '''Prune input file for duplicate input'''
+def subtree_key(rel, child):
+    '''Key for a relation + subtree, based on the canonical hash of the subtree'''
+    if isinstance(child, AMRNode):
+        return (rel, child.hash)
+    return (rel, child)
+
+
+def map_variables(pruned, kept, var_map):
+    '''Map the variables of a pruned subtree to the variables of the identical subtree we kept
+       Children can be in a different order, so we match them by their key'''
+    var_map[pruned.var] = kept.var
+    kept_children = {}
+    for rel, kept_child in kept.children:
+        if isinstance(kept_child, AMRNode):
+            kept_children.setdefault(subtree_key(rel, kept_child), []).append(kept_child)
+    for rel, pruned_child in pruned.children:
+        if isinstance(pruned_child, AMRNode) and kept_children.get(subtree_key(rel, pruned_child)):
+            map_variables(pruned_child, kept_children[subtree_key(rel, pruned_child)].pop(0), var_map)
+
+
+def prune_children(node, counts, first_kept, var_map):
+    '''Remove children with the same relation + subtree under the same parent, and children
+       we already saw twice in the full AMR. Then prune the children we kept (depth-first)
+       Returns the number of pruned children'''
+    kept, seen_here = [], {}
+    for rel, child in node.children:
+        key = subtree_key(rel, child)
+        if key in seen_here:
+            # Same relation + subtree under the same parent
+            if isinstance(child, AMRNode):
+                map_variables(child, seen_here[key], var_map)
+            continue
+        if not isinstance(child, AMRNode):
+            # Constants (e.g. :polarity -) and references are only pruned under the same parent
+            kept.append([rel, child])
+            seen_here[key] = child
+            continue
+        if counts[key] >= 2:
+            # Seen this node twice already, so this is the third (or more) occurrence
+            map_variables(child, first_kept[key], var_map)
+        else:
+            kept.append([rel, child])
+            seen_here[key] = child
+            first_kept.setdefault(key, child)
+        counts[key] += 1
+    num_pruned = len(node.children) - len(kept)
+    node.children = kept
+
+    for _, child in kept:
+        if isinstance(child, AMRNode):
+            num_pruned += prune_children(child, counts, first_kept, var_map)
+    return num_pruned
+
+
+def replace_references(node, var_map):
+    '''Let references to variables of pruned nodes point to the variables we kept'''
+    for item in node.children:
+        if isinstance(item[1], AMRNode):
+            replace_references(item[1], var_map)
+        else:
+            # The node we kept might have been pruned itself later on
+            seen = set()
+            while item[1] in var_map and item[1] not in seen:
+                seen.add(item[1])
+                item[1] = var_map[item[1]]
+
+
+def prune_amr(line):
+    '''Prune a single one-line AMR, return the pruned AMR line and the number of pruned nodes
+       AMRs that can not be parsed are returned as is'''
+    try:
+        root = parse_amr_tree(line)
+    except ValueError:
+        return " ".join(line.split()), 0
+    # Duplicates are found by comparing canonical hashes of the subtrees
+    add_subtree_hashes(root)
+    var_map = {}
+    num_pruned = prune_children(root, Counter(), {}, var_map)
+    if var_map:
+        replace_references(root, var_map)
+    return amr_tree_to_string(root), num_pruned
+
+
+def prune_file(input_file):
+    '''Prune input file for duplicate input, write to .pruned'''
     filtered_amrs = []
     changed = 0
 
     for line in open(input_file, 'r'):
-        # Delete variables from line
-        clean_line = re.sub(r'\([A-Za-z0-9-_~]+ / ', r'(', line).strip()
-
-        # Only try to do something if we can actually permute
-        if count_not_between_quotes(':', clean_line) > 1:
-            # Get initial permutations
-            permutations, keep_string1, all_perms = get_permutations(clean_line, 1, [], 'prune', cut_off)
-            keep_str = '(' + keep_string1
-            # Prune duplicate output here
-            final_string = get_best_perm(permutations, keep_str, all_perms, 'prune', cut_off)
-
-            # Create final AMR line
-            add_to = " ".join(create_final_line(final_string).split())
-            clean_line = " ".join(clean_line.split())
-            filtered_amrs.append(add_to)
-
-            # Keep track of number of pruned AMRs
-            if add_to != clean_line:
-                changed += 1
-        else:
-            filtered_amrs.append(clean_line.strip())
+        pruned, num_pruned = prune_amr(line)
+        filtered_amrs.append(pruned)
+        # Keep track of number of pruned AMRs
+        if num_pruned:
+            changed += 1
 
-    # Restore variables and write to file
-    restore_variables(input_file, filtered_amrs)
+    write_to_file(filtered_amrs, input_file + '.pruned')
     print('Changed {0} AMRs by pruning'.format(changed))
 
 
 if __name__ == '__main__':
     args = create_arg_parser()
-    prune_file(args.input_file, args.cut_off)
-
-
+    prune_file(args.input_file)
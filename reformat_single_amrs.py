@@ -6,7 +6,7 @@
 
 import sys
 import argparse
-from amr_utils import valid_amr, write_to_file, tokenize_line, reverse_tokenize
+from amr_utils import valid_amr, countparens, tokenize_line, reverse_tokenize, parse_amr_tree, AMRNode
 
 
 def create_arg_parser():
@@ -26,51 +26,84 @@ def variable_match(token):
     return any(char.isalpha() for char in token) and any(char.isdigit() for char in token) and not token.startswith(':') and len([x for x in token if x.isalpha() or x.isdigit() or x == '-']) == len(token)
 
 
-def reformat_amr(input_file):
-    '''Reformat AMRs -- go from single line to indented AMR on multiple lines'''
-    fixed_amrs = []
-
-    # Loop over input file with one AMR per line
-    for line in open(input_file, 'r'):
-        tokenized_line = tokenize_line(line).split()
-        num_tabs = 0
-        amr_string = []
-        # Loop over parts of tokenized line
-        for count, part in enumerate(tokenized_line):
-            if part == '(':
-                num_tabs += 1
-                amr_string.append(part)
-            elif part == ')':
-                num_tabs -= 1
-                amr_string.append(part)
-            elif part.startswith(':'):
-                try:
-                    # Variable coming up
-                    if tokenized_line[count+3] == '/':
-                        amr_string.append('\n' + num_tabs * '\t' + part)
-                    # Variable coming, add newline here
-                    elif variable_match(tokenized_line[count+1]):
-                        amr_string.append('\n' + num_tabs * '\t' + part)
-                    else:
-                        amr_string.append(part)
-                except:
-                    amr_string.append(part)
-            else:
-                amr_string.append(part)
-
-        original_line = reverse_tokenize(" ".join(amr_string))
-        original_line = original_line.replace('_ (', '_(').replace(') "', ')"')
-        fixed_amrs.append(original_line + '\n\n')
-    return fixed_amrs
+def plain_token(token):
+    '''Whether a variable, concept or constant is read the same by the AMR parser of valid_amr: quoted,
+       or without the characters that have a meaning there'''
+    return (len(token) > 1 and token.startswith('"') and token.endswith('"')) or not any(char in token for char in '/:"')
 
 
-if __name__ == "__main__":
-    args = create_arg_parser()
-    fixed_amrs = reformat_amr(args.input_file)
-    # Check if AMRs are valid, error if they're not
-    if args.valid:
-        for amr in fixed_amrs:
-            if not valid_amr(amr):
+def format_node(node, depth, parts, variables):
+    '''Add the indented format of a parsed AMR node to parts: relations to other nodes start on a new line with one tab
+       per level. Constants are added as (depth, relation, value), because whether they are re-entrant variables is
+       only known after the whole AMR is done. Returns whether the node and its children are valid'''
+    valid = node.var not in variables and plain_token(node.var) and plain_token(node.concept)
+    variables.add(node.var)
+    parts.append('(' + node.var + ' / ' + node.concept)
+    for rel, child in node.children:
+        valid = valid and len(rel) > 1 and plain_token(rel[1:])
+        if isinstance(child, AMRNode):
+            parts.append('\n' + depth * '\t' + rel + ' ')
+            valid = format_node(child, depth + 1, parts, variables) and valid
+        else:
+            valid = valid and plain_token(child)
+            parts.append((depth, rel, child))
+    parts.append(')')
+    return valid
+
+
+def format_tokens(line):
+    '''Reformat an AMR that could not be parsed by looking at the tokens only'''
+    tokenized_line = tokenize_line(line).split()
+    num_tabs = 0
+    amr_string = []
+    # Loop over parts of tokenized line
+    for count, part in enumerate(tokenized_line):
+        if part == '(':
+            num_tabs += 1
+        elif part == ')':
+            num_tabs -= 1
+        elif part.startswith(':') and count + 3 < len(tokenized_line):
+            # Variable coming up (new node or re-entrancy), add newline here
+            if tokenized_line[count+3] == '/' or variable_match(tokenized_line[count+1]):
+                part = '\n' + num_tabs * '\t' + part
+        amr_string.append(part)
+
+    original_line = reverse_tokenize(" ".join(amr_string))
+    return original_line.replace('_ (', '_(').replace(') "', ')"')
+
+
+def format_amr(line, check_valid=True):
+    '''Reformat a single-line AMR to an indented AMR on multiple lines and check whether it is valid, in a single walk
+       over the parsed AMR. Only AMRs that the tree parser does not accept as they are go to valid_amr'''
+    try:
+        root = parse_amr_tree(line)
+    except ValueError:
+        return format_tokens(line).strip(), check_valid and valid_amr(line)
+
+    parts, variables = [], set()
+    valid = format_node(root, 1, parts, variables) and countparens(line)
+    amr_string = []
+    for part in parts:
+        if isinstance(part, tuple):
+            depth, rel, value = part
+            # Re-entrant variables start on a new line, other constants stay on the same line
+            part = '\n' + depth * '\t' + rel + ' ' + value if value in variables else ' ' + rel + ' ' + value
+        amr_string.append(part)
+    return "".join(amr_string), valid or (check_valid and valid_amr(line))
+
+
+def reformat_amr(input_file, out_file, check_valid):
+    '''Reformat AMRs -- go from single line to indented AMR on multiple lines, one AMR at a time
+       With check_valid we raise an error for the first invalid AMR'''
+    with open(out_file, 'w') as out_f:
+        # Loop over input file with one AMR per line
+        for line in open(input_file, 'r'):
+            amr, valid = format_amr(line, check_valid)
+            if check_valid and not valid:
                 raise ValueError(amr)
-    write_to_file(fixed_amrs, args.input_file + args.extension, extra_newline=True)
+            out_f.write(amr + '\n\n')
 
+
+if __name__ == "__main__":
+    args = create_arg_parser()
+    reformat_amr(args.input_file, args.input_file + args.extension, args.valid)
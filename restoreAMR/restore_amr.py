@@ -3,7 +3,7 @@
 
 '''Script that restores AMR variables. Most of the code is from https://github.com/didzis/tensorflowAMR/tree/master/SemEval2016
 
-Possible to restore AMRs that used the Indexing or absolute Paths method, described in "Dealing with Co-reference in Neural Semantic Parsing", Van Noord and Bos, 2017
+Possible to restore AMRs that used the Indexing or absolute/relative Paths method, described in "Dealing with Co-reference in Neural Semantic Parsing", Van Noord and Bos, 2017
 
 Sample input:
 
@@ -13,274 +13,308 @@ Sample output:
 
 (vvlook-01 / look-01 :mode imperative :ARG0 (vvyou / you))
 
-This script should also work for word-level input (though mostly tested on char-level)'''
+This script should also work for word-level input (though mostly tested on char-level)
+
+With --serve PORT the script runs as a local HTTP daemon that keeps the reference dict loaded. POST one-line
+decoder outputs (one per line) to it and it returns the final AMRs (restored, pruned, coref added), one per line'''
 
 
 import sys
 import re
 import random
 import argparse
-from amr_utils import load_dict, left_space_for_char, space_brackets_amr, is_number, remove_char_outside_quotes, tokenize_line, reverse_tokenize, write_to_file, between_quotes, replace_not_in_quotes
-from best_amr_permutation import filter_colons, get_keep_string
-from var_free_amrs import process_var_line
-
-
-# General regex for fixing invalid AMRs
-unbracket = re.compile(r'\(\s*([^():\s"]*)\s*\)[^"]')
-dangling_edges = re.compile(r':[\w\-]+\s*(?=[:)])')
-missing_edges = re.compile(r'(\/\s*[\w\-]+)\s+\(')
-missing_variable = re.compile(r'(?<=\()\s*([\w\-]+)\s+(?=:)')
-missing_quotes = re.compile(r'("\w+)(?=\s\))')
-misplaced_colon = re.compile(r':(?=\))')
-missing_concept_and_variable = re.compile(r'(?<=\()\s*(?=:\w+)')
-dangling_quotes = re.compile(r'(?<=\s)(\w+)"(?=\s|\)|:)')
+from collections import Counter
+from multiprocessing import Pool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from amr_utils import get_default_amr, valid_amr, load_dict, space_brackets_amr, is_number, remove_char_outside_quotes, reverse_tokenize, write_to_file, between_quotes, parse_amr_tree, amr_tree_to_string, AMRNode
+import prune_amrs
+from char_level_AMR import CharCodec
+import restore_duplicate_coref
+
+
+# Relation values that are never put between quotes
+no_quote_values = ['-', 'interrogative', 'expressive', 'imperative']
+
+# Single scanner for normalize_line, every alternative is a token that needs a rewrite (see normalize_token)
+# Brackets, colons and spaces only match if they are not separated correctly yet
+normalize_re = re.compile(r"""
+    (?=[":*{}^|()\s])                                          # fail fast on all other characters
+    (?:(?P<quote>"(?:[^"]*")?)                                  # quoted string (never changed) or unclosed quote
+  | (?P<index>\*\d+\*)                                          # coreference index, e.g. *1*
+  | (?P<path>[{}^]|\|\d+\|)                                     # absolute/relative path tokens
+  | (?P<polarity>:polarity\s*-) | (?P<wiki>:wiki\s*-) | (?P<polite>:polite\s*\+)
+  | :(?P<extra>op\d(?=\d\d|\d+\.\d)|(?:mod|ARG)\d(?=\d+\.\d))   # op123.5 to op1 23.5, ARG12.5 to ARG1 2.5
+  | :(?P<argnum>(?:ARG|op)\d(?=\d+(?:\.\d+)?[\s)]*(?::|$)))     # ARG2444 to ARG2 444
+  | :(?P<relnum>(?:(?!ARG|op|snt)[A-Za-z])+(?=\d[\w.,]*(?<=\d)[\s)]*(?::|$)))   # quant100 to quant 100
+  | (?P<colon>(?<!\s):)                                         # relation without space before it
+  | (?P<open>(?<![\s(_])\()                                     # but keep wiki links: :wiki "link_(information)"
+  | (?P<close>\)(?=[^\s)"]))
+  | (?P<drop>(?<=\()\s+|\s+(?=\)))                              # no space after an opening or before a closing bracket
+  | (?P<space>\s\s+))
+""", re.X)
+# Fixed rewrites of the tokens of normalize_re
+normalize_rewrites = {'polarity': ' :polarity 100', 'wiki': ' :wiki "100"', 'polite': ' :polite 100', 'colon': ' :',
+                      'open': ' (', 'close': ') ', 'drop': '', 'space': ' '}
+# Decoder of the (char-level) model output, the same for all char-level modes
+char_codec = CharCodec()
+# How coreference was restored, counted for indexing and with the paths for the paths method (see new_coref_stats)
+index_replace_types = ['Normal case', 'Replace by variable that is not referred to', 'Replace by most frequent index', 'Replace by most frequent concept', 'No concepts found - do person']
+path_replace_types = ['Path lead to variable', 'Path did not lead to variable']
+# Paths are rewritten to COREF tokens by preprocess_abs, e.g. COREF*COLONARG1*|1|, also as a node (vv1 / COREF*...)
+coref_token_re = re.compile(r'COREF\*[^\s()"]*')
+# COREF token with its relation (if any): as a node, as a quoted value or by itself (e.g. in a string)
+coref_edge_re = re.compile(r'(?:\s*:[^\s()"]+)?\s*(?:\((?:\S+\s+/\s+)?COREF\*[^\s()"]*\)|"COREF\*[^\s()"]*"|COREF\*[^\s()"]*)')
+# Reference dict of the worker processes, set by init_worker (also works when the workers are not forked)
+worker_ref_dict = {}
 
 
 def create_arg_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-f", "--input_file", required=True, type=str, help="File with AMRs (one line)")
-    parser.add_argument("-o", "--output_file", required=True, type=str, help="Output file")
-    parser.add_argument('-c', "--coreference", default='dupl', choices=['dupl', 'index', 'abs'], help='How to handle coreference - input was either duplicated/indexed/absolute path (default dupl)')
+    parser.add_argument("-f", "--input_file", type=str, help="File with AMRs (one line)")
+    parser.add_argument("-o", "--output_file", type=str, help="Output file")
+    parser.add_argument('-c', "--coreference", default='dupl', choices=['dupl', 'index', 'abs', 'rel'], help='How to handle coreference - input was either duplicated/indexed/absolute path/relative path (default dupl)')
     parser.add_argument("-r", "--ref_dict", default='restoreAMR/ref_dict', type=str, help="Ref dict file")
     parser.add_argument('-p', '--print_stats', action='store_true', help='Print coreference statistics')
+    parser.add_argument('-s', '--serve', default=0, type=int, help='Run as a local HTTP daemon on this port instead of processing -f')
+    parser.add_argument('-n', '--n_best', default=1, type=int, help='Number of decoder hypotheses per sentence in the input file (default 1)')
+    parser.add_argument('-w', '--workers', default=4, type=int, help='Number of worker processes for n-best restoring and for batches in daemon mode (default 4)')
     args = parser.parse_args()
+    if not args.serve and (not args.input_file or not args.output_file):
+        parser.error('-f and -o are required when not running with --serve')
     return args
 
 
-def preprocess(line, coreference):
-    '''Preprocess line back to format without + for space. Special case:
-       :polite +, we need to keep that'''
-    line = line.replace(':polite +', ':polite 100')
-    line = line.replace(' ', '')
-    line = replace_not_in_quotes(line, '+', ' ')
-    # Absolute paths need a different preprocessing step
-    if coreference == 'abs':
-        line = preprocess_abs(line)
-    return line
+def normalize_line(line, coreference):
+    '''Normalize a decoded line before restoring, all rewrites are done in a single scan with normalize_re:
+         - back to format without + for space with the CharCodec (special case: :polite +, we need to keep that)
+         - spaces around brackets, but not in wiki links: :wiki "link_(information)", quoted strings are never changed
+         - extra space before colons, brackets and opening quotes
+         - keep polarity - and wiki - from being removed (restored by restore_rewrites)
+         - split relations and numbers, e.g. quant100 to quant 100 and op123.5 to op1 23.5
+         - separate coreference indexes, e.g. *1*, and the tokens of absolute and relative paths'''
+    line = char_codec.decode(line)
+    paths = coreference in ['abs', 'rel'] and '{' in line
+    line = normalize_re.sub(lambda match: normalize_token(match, paths), line)
+    return preprocess_abs(line) if paths else line
+
+
+def normalize_token(match, paths):
+    '''Return the rewrite for a single match of normalize_re'''
+    kind = match.lastgroup
+    if kind in normalize_rewrites:
+        return normalize_rewrites[kind]
+    tok = match.group(0)
+    if kind == 'quote':
+        # Space before opening quotes, but not directly after a closing bracket
+        prev = match.string[match.start() - 1] if match.start() else ' '
+        return tok if prev == ')' or prev.isspace() else ' ' + tok
+    elif kind == 'index':
+        return ' ' + tok + ' '
+    elif kind == 'path':
+        return ' ' + tok + ' ' if paths else tok
+    # Relation glued to a number
+    return ' :' + match.group(kind) + ' '
 
 
 def initial_check(coreference, ref_file):
     '''Do initial checks and prints, load dicts as well'''
-    if coreference == 'index':
-        replace_types = ['Normal case', 'Replace by variable that is not referred to', 'Replace by most frequent index', 'Replace by most frequent concept', 'No concepts found - do person']
-        index_dict = dict.fromkeys(replace_types, 0)
-    elif coreference == 'abs':
-        replace_types = ['Path lead to variable', 'Path did not lead to variable']
-        index_dict = {}
-        index_dict[replace_types[0]] = []
-        index_dict[replace_types[1]] = []
-    else:
-        index_dict = {}
-        replace_types = []
-
     # Load dictionary with frequency information
     ref_dict = load_dict(ref_file)
-    return ref_dict, index_dict, replace_types
+    return ref_dict, new_coref_stats(coreference)
+
+
+def new_coref_stats(coreference):
+    '''Return empty statistics of how the coreference was restored: a count per replace type for indexing,
+       the paths per replace type for the paths method'''
+    if coreference == 'index':
+        return dict.fromkeys(index_replace_types, 0)
+    elif coreference in ['abs', 'rel']:
+        return {key: [] for key in path_replace_types}
+    return {}
+
+
+def merge_coref_stats(stats, new_stats):
+    '''Add the coreference statistics of new_stats (e.g. of a worker process) to stats'''
+    for key, value in new_stats.items():
+        stats[key] += value
+
+
+def init_worker(ref_dict):
+    '''Give a worker process the reference dict, it is not inherited when processes are spawned'''
+    worker_ref_dict.update(ref_dict)
 
 
 #### General restore functions (mostly from https://github.com/didzis/tensorflowAMR/tree/master/SemEval2016)
 
 def remove_dangling_edges(line):
-    '''Remove unfinished edges (can happen with char-level output)'''
-    if line[-1] != ')':
-        line = ")".join(line.split(')')[:-1]) + ')'
-    return line
+    '''Remove unfinished edges after the last closing bracket (can happen with char-level output)'''
+    return line[:line.rfind(')') + 1] or ')'
 
 
-def replace_var(m):
-    global c
-    global cc
-    global ggg
-    if ['name', 'date'].count(m.group(1)) == 1:
-        c += 1
-        return '(v' + str(ggg) + str(c) + ' / ' + m.group(1) + m.group(2)
-    if cc.count(m.group(1)) == 0:
-        cc.append(m.group(1))
-        return '(vv' + str(ggg) + m.group(1) + ' / ' + m.group(1) + m.group(2)
-    # Don't replace duplicates for abs/index
-    if m.group(2) == ' )' and args.coreference not in ['abs', 'index']:
-        return ' vv' + str(ggg) + m.group(1)
-    c += 1
-    return '(vvvv' + str(ggg) + str(c) + ' / ' + m.group(1) + m.group(2)
-
-
-def replace_var2(m):
-    if m.group(2) == "-":
-        return "%s %s" % (m.group(1), m.group(2))
-    if m.group(2) == "interrogative":
-        return "%s %s" % (m.group(1), m.group(2))
-    if m.group(2) == "expressive":
-        return "%s %s" % (m.group(1), m.group(2))
-    if m.group(2) == "imperative":
-        return "%s %s" % (m.group(1), m.group(2))
-    return "%s \"%s\"" % (m.group(1), m.group(2))
-
-
-def add_quotes(m):
-    value = m.group(2).strip()
-    if value == '-':
-        return '%s %s ' % (m.group(1), value)
-    return '%s "%s" ' % (m.group(1), value)
-
-
-def convert(line):
-    line = line.rstrip().lstrip(' \xef\xbb\xbf\\ufeff')
-    line = line.rstrip().lstrip('> ')
-    line = " ".join(line.split())
-    global cc
-    global c
-    global ggg
-    c = 0
-    cc = []
-    old_line = line
-    while True:
-        line = re.sub(r'(\( ?name [^()]*:op\d+|:wiki) ([^\-_():"][^():"]*)(?=[:\)])', add_quotes, line, re.I)
-        if old_line == line:
-            break
-        old_line = line
-    # Add variables back here
-    line = ' ' + line
-    line = re.sub(r'[^_]\(\s*([\w\-\d]+)(\W|\))', replace_var, line)
-
-    # Make sure parentheses match
-    open_count = 0
-    close_count = 0
-    for i, c in enumerate(line):
-        if c == '(':
-            open_count += 1
-        elif c == ')':
-            close_count += 1
-        if open_count == close_count and open_count > 0:
-            line = line[:i].strip()
-            break
+def tokenize_restore(line):
+    '''Split a variable-free AMR in brackets and other tokens, quoted strings are never split
+       Also split relations that are glued to their value, e.g. :modeimperative'''
+    line = re.sub(r'(:[a-z]+)(imperative|interrogative|expressive)(?=[\s)])', r'\1 \2', line)
+    return re.findall(r'(?:[^\s()"]+|"[^"]*")+|[()]|"[^\s()"]*', line)
 
-    old_line = line
-    while True:
-        open_count = len(re.findall(r'\(', line))
-        close_count = len(re.findall(r'\)', line))
-        if open_count > close_count:
-            line += ')' * (open_count-close_count)
-        elif close_count > open_count:
-            for i in range(close_count-open_count):
-                line = line.rstrip(')')
-                line = line.rstrip(' ')
-
-        if old_line == line:
-            break
-        old_line = line
 
-    old_line = line
-
-    while True:
-        line = re.sub(r'(:\w+) ([^\W\d\-][\w\-]*)(?=\W)', replace_var2, line, re.I)
-        if old_line == line:
-            break
-        old_line = line
-
-    # Add the extra spaces that are sometimes needed
-    extra_space_needed = ['imperative', 'interrogative', 'expressive']
-    for esn in extra_space_needed:
-        line = line.replace(esn, ' {0} '.format(esn))
-
-    # Fix other problems that might still be there
-    line = unbracket.sub(r'\1', line, re.U)
-    line = dangling_edges.sub('', line, re.U)
-    line = missing_edges.sub(r'\1 :ARG2 (', line, re.U)
-    line = missing_variable.sub(r'vvvx / \1 ', line, re.U)
-    line = missing_quotes.sub(r'\1"', line, re.U)
-    line = misplaced_colon.sub(r'', line, re.U)
-    line = missing_concept_and_variable.sub(r'd / dummy ', line, re.U)
-    line = dangling_quotes.sub(r'\1', line, re.U)
-    return line
+def is_relation(tok):
+    '''Relations start with a colon, e.g. :ARG0'''
+    return len(tok) > 1 and tok[0] == ':'
 
 
-def add_space_when_digit(line):
-    '''Add a space when see a digit, except for arguments of id_list'''
-    id_list = ['ARG', 'op', 'snt', '-']
-
-    spl = line.split(':')
-    for idx in range(1, len(spl)):
-        if spl[idx].strip().replace(')', ''):
-            check_arg = spl[idx].replace(')', '').replace('ARG', '').strip()
-            check_op = spl[idx].replace(')', '').replace('op', '').strip()
-            # If there is a digit after quant or value, put a space so we don't error, e.g. :value3 becomes :value 3, but not for op, snt and ARG
-            if spl[idx].strip().replace(')', '')[-1].isdigit() and (not any(x in spl[idx] for x in id_list)):
-                new_string = ''
-                added_space = False
-                for ch in spl[idx]:
-                    if ch.isdigit():
-                        if not added_space:
-                            new_string += ' ' + ch
-                            added_space = True
-                        else:
-                            new_string += ch
+def fix_value(rel, value_toks, concept):
+    '''Return the value for a relation, with quotes where they are needed. Names and wiki links
+       can consist of multiple tokens, for other relations we only keep the first token'''
+    if (concept == 'name' and re.match(r':op\d+$', rel)) or rel == ':wiki':
+        value = " ".join(value_toks)
+        if value[0] not in '-_"' or (value[0] == '"' and len(value_toks) > 1):
+            # Multiple tokens become a single quoted value
+            return '"' + " ".join(tok.strip('"') for tok in value_toks) + '"'
+    else:
+        value = value_toks[0]
+    if value[0] == '"':
+        # Make sure quotes are closed
+        return value if len(value) > 1 and value[-1] == '"' else value + '"'
+    value = value.rstrip('"')
+    if value and (value[0].isalpha() or value[0] == '_') and value not in no_quote_values:
+        return '"' + value + '"'
+    return value
+
+
+class VariableRestorer(object):
+    '''Tolerant single-pass parser that reads a variable-free AMR and writes it with variables.
+       Variable names: v + amr_id + counter for name and date, vv + amr_id + concept for the first
+       occurrence of a concept and vvvv + amr_id + counter for later occurrences.
+
+       It also fixes problems with the (char-level) output on the fly: missing quotes, relations without value,
+       nodes without relation (get :ARG2) or concept (get dummy), empty nodes, missing or superfluous brackets.
+       The number of fixes is kept in self.repairs, a cheap score of how malformed the input was'''
+
+    def __init__(self, line, amr_id):
+        self.tokens = tokenize_restore(line)
+        self.amr_id = str(amr_id)
+        self.idx = 0
+        self.counter = 0
+        self.seen_concepts = set()
+        self.repairs = 0
+
+    def get_var(self, concept):
+        if concept in ['name', 'date']:
+            self.counter += 1
+            return 'v' + self.amr_id + str(self.counter)
+        if concept not in self.seen_concepts:
+            self.seen_concepts.add(concept)
+            return 'vv' + self.amr_id + concept
+        self.counter += 1
+        return 'vvvv' + self.amr_id + str(self.counter)
+
+    def peek(self):
+        return self.tokens[self.idx] if self.idx < len(self.tokens) else None
+
+    def restore(self):
+        # Skip tokens before the start of the AMR, if there is no bracket at all we just start
+        while self.peek() is not None and self.peek() != '(':
+            self.repairs += 1
+            if is_relation(self.peek()) or self.idx + 1 == len(self.tokens):
+                self.idx = 0
+                break
+            self.idx += 1
+        if self.peek() == '(':
+            self.idx += 1
+        # Everything after the closing bracket of the root is ignored
+        node = self.parse_node()
+        self.repairs += len(self.tokens) - min(self.idx, len(self.tokens))
+        if not node:
+            self.repairs += 1
+            return '(' + self.get_var('dummy') + ' / dummy)'
+        return node
+
+    def parse_node(self):
+        '''Parse node, opening bracket is already consumed. Returns the node as string, or None if it is empty'''
+        tok = self.peek()
+        if tok is None or tok == ')':
+            self.idx += 1
+            self.repairs += 1
+            return None
+        if tok == '(' or is_relation(tok):
+            concept = 'dummy'
+            self.repairs += 1
+        else:
+            # Concepts are word-like, anything after the word is kept as well (e.g. COREF*COLONARG0*|1|)
+            concept = tok.strip('"') if tok[0] == '"' else tok
+            self.idx += 1
+            # Skip extra tokens that are not a relation
+            while self.peek() is not None and self.peek() not in ['(', ')'] and not is_relation(self.peek()):
+                self.idx += 1
+                self.repairs += 1
+        match = re.match(r'[\w\-]+', concept)
+        parts = ['(' + self.get_var(match.group(0) if match else concept) + ' / ' + concept]
+
+        closed = False
+        while self.peek() is not None:
+            tok = self.peek()
+            self.idx += 1
+            if tok == ')':
+                closed = True
+                break
+            elif tok == '(':
+                # Node without a relation, add a general one
+                self.repairs += 1
+                child = self.parse_node()
+                if child:
+                    parts.append(':ARG2 ' + child)
+            elif is_relation(tok):
+                nxt = self.peek()
+                if nxt == '(':
+                    self.idx += 1
+                    child = self.parse_node()
+                    if child:
+                        parts.append(tok + ' ' + child)
+                elif nxt is not None and nxt != ')' and not is_relation(nxt):
+                    value_toks = []
+                    while self.peek() is not None and self.peek() not in ['(', ')'] and not is_relation(self.peek()):
+                        value_toks.append(self.peek())
+                        self.idx += 1
+                    value = fix_value(tok, value_toks, concept)
+                    if value:
+                        parts.append(tok + ' ' + value)
                     else:
-                        new_string += ch
-                spl[idx] = new_string
-            elif is_number(check_arg):                #change ARG2444 to ARG2 444
-                spl[idx] = re.sub(r'(ARG\d)([\d\.]+)', r'\1 \2', spl[idx])
-            elif is_number(check_op):                #change op124 to op1 24
-                spl[idx] = re.sub(r'(op\d)([\d\.]+)', r'\1 \2', spl[idx])
-    return ':'.join(spl)
-
-
-def separate_quotes(line):
-    '''Separate quotes from an argument + value, i.e.
-       :op1"tom" to :op1 "tom" '''
-    quotes = 0
-    new_line = ''
-
-    for ch in line:
-        if ch == '"':
-            quotes += 1
-            if quotes % 2 != 0 and new_line[-1] != ' ':
-                new_line += ' "'                            #add space for quote
+                        self.repairs += 1
+                else:
+                    # Relation without a value, just ignore it
+                    self.repairs += 1
             else:
-                new_line += ch
-        else:
-            new_line += ch
-    return new_line
+                # Loose token without relation, ignore it
+                self.repairs += 1
+        if not closed:
+            self.repairs += 1
+        return " ".join(parts) + ')'
 
-def do_extra_steps(line):
-    '''Do some extra necessary postprocessing/fixing steps'''
-    # Add extra space for colons and parentheses
-    line = line.replace(':', ' :')
-    line = line.replace('(', ' (')
-
-    # Make sure quotes always start with a leading space (but not end)
-    line = separate_quotes(line)
-
-    # We want to make sure that we do Wiki links correctly
-    # They always look like this :wiki "link_(information)"
-    new_line = line.replace('_ (', '_(').replace(') "', ')"')
-
-    # Fix problem with op and numbers, e.g. change op123.5 to op1 23.5
-    new_line = re.sub(r'(op\d)(\d\d+)', r'\1 \2', new_line)
-    new_line = re.sub(r'(op\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-    new_line = re.sub(r'(mod\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-    new_line = re.sub(r'(ARG\d)(\d+)\.(\d+)', r'\1 \2.\3', new_line)
-
-    # Make sure polarity and wiki links do not accidentally get removed, this will be
-    # restored in a later step
-    new_line = new_line.replace(':polarity-', ':polarity 100').replace(':wiki-', ':wiki "100"')
-    new_line = new_line.replace(':polarity -', ':polarity 100').replace(':wiki -', ':wiki "100"')
-    # Make sure that the paths are treated as separate tokens later
-    new_line = re.sub(r'(\*[\d]+\*)', r' \1 ', new_line)
-    return new_line
+
+def convert(line, amr_id, return_repairs=False):
+    '''Restore the variables of a variable-free AMR (and fix it if necessary)
+       Optionally also return the number of fixes that were needed'''
+    line = line.rstrip().lstrip(' \xef\xbb\xbf\\ufeff')
+    line = line.rstrip().lstrip('> ')
+    restorer = VariableRestorer(line, amr_id)
+    line = restorer.restore()
+    return (line, restorer.repairs) if return_repairs else line
 
 
-def add_coref_instance(next_items):
-    '''Add coreference items that are instantiated by this:
+def add_coref_instance(tok_line, start):
+    '''Add coreference items that are instantiated by the tokens from start on:
     *0* country :wiki "possible value" :add "more_values"'''
     add_items = []
-    for idx, item in enumerate(next_items):
+    for idx in range(start, len(tok_line)):
+        item = tok_line[idx]
         if item.strip()[0] in [')', '(']:
             # We are done with adding, return
             return remove_char_outside_quotes("-----".join(add_items), ')')
         elif item.startswith(':'):
             # Only add this item if next one is a constant, i.e. between quotes or number
             # If not, we stop
-            if idx + 1 < len(next_items) and (is_number(next_items[idx+1]) or between_quotes(next_items[idx+1])):
+            if idx + 1 < len(tok_line) and (is_number(tok_line[idx+1]) or between_quotes(tok_line[idx+1])):
                 add_items.append(item)
             else:
                 return remove_char_outside_quotes("-----".join(add_items), ')')
@@ -295,19 +329,23 @@ def add_coref_instance(next_items):
         return ''
 
 
-def restore_coref_indexing(line, ref_dict):
-    '''Restore coreference items, e.g. *3* and *2* with actual word'''
+def restore_coref_indexing(line, ref_dict, stats):
+    '''Restore coreference items, e.g. *3* and *2* with actual word, the replace types are counted in stats'''
     pattern = re.compile(r'^\*[\d]+\*$')
     # Make sure coref indexes are separate
     tok_line = line.split()
     seen_coref = {}
+    index_counts = Counter()
     new_tok = []
+    # Rankings for the fallback cases are only computed when we need them
+    word_ranking, referent_ranking = None, None
 
-    # First find all instantiated indexes
+    # First find all instantiated indexes and count how often each index occurs
     for idx, item in enumerate(tok_line):
         if pattern.match(item):
+            index_counts[item] += 1
             if idx < len(tok_line) -1:
-                instant_value = add_coref_instance(tok_line[idx+1:])
+                instant_value = add_coref_instance(tok_line, idx + 1)
                 # Only add if it actually was an instantiation
                 if instant_value:
                     seen_coref[item] = instant_value
@@ -317,7 +355,8 @@ def restore_coref_indexing(line, ref_dict):
         if pattern.match(item):
             # Can't look ahead to idx + 1 here
             if idx == len(tok_line) -1:
-                referent = get_most_frequent_word(tok_line, ref_dict)
+                word_ranking = word_ranking or rank_words(tok_line, ref_dict)
+                referent = get_most_frequent_word(word_ranking, stats)
                 new_tok.append('(coref-{0})'.format(referent))
             # Instantiated case, just removing index is enough
             # I.e. *0* work, we remove the *0* and just keep work
@@ -328,16 +367,18 @@ def restore_coref_indexing(line, ref_dict):
                 if item in seen_coref:
                     # Normal case, reference to instantiated index
                     referent = seen_coref[item]
-                    index_dict[replace_types[0]] += 1
+                    stats[index_replace_types[0]] += 1
                 # Problem: we have an index but it was never instantiated
                 else:
                     # Solution: add most frequent other referent (most rather have one that was never instantiated),
                     # if they are all not in train set add one at random
                     if len(seen_coref) > 0:
-                        referent = get_most_frequent_referent(seen_coref, ref_dict, tok_line)
+                        referent_ranking = referent_ranking or rank_referents(seen_coref, ref_dict, index_counts)
+                        referent = get_most_frequent_referent(referent_ranking, seen_coref, stats)
                     # If there are no other referents just add the most frequent one in general based on all words in sentence
                     else:
-                        referent = get_most_frequent_word(tok_line, ref_dict)
+                        word_ranking = word_ranking or rank_words(tok_line, ref_dict)
+                        referent = get_most_frequent_word(word_ranking, stats)
                 # Hacky: we have no variables here, we need to recognize that we need to replace this word in a later stage without
                 # messing up the restoring variables process. We also add unneccesary brackets to not mess up the variable restoring
                 # process, we remove them in a later stage as well
@@ -352,8 +393,9 @@ def restore_coref_indexing(line, ref_dict):
     return new_line
 
 
-def get_most_frequent_word(tok_line, ref_dict):
-    '''Function that returns the concept in the AMR (tok_line) that is most frequently a referent in the training set (ref_dict)'''
+def rank_words(tok_line, ref_dict):
+    '''Return the concept in the AMR (tok_line) that is most frequently a referent in the training set (ref_dict),
+       its frequency (-1 if there is none) and all words of the AMR'''
     most_freq, score = '', -1
     words = []
 
@@ -365,33 +407,37 @@ def get_most_frequent_word(tok_line, ref_dict):
                 if ref_dict[item] > score:
                     score = ref_dict[item]
                     most_freq = item
+    return most_freq, score, words
+
 
+def get_most_frequent_word(word_ranking, stats):
+    '''Function that returns the most frequent referent based on all words in the AMR'''
+    most_freq, score, words = word_ranking
     if score > -1:
         # Return word that most often has a referent in training set
-        index_dict[replace_types[3]] += 1
+        stats[index_replace_types[3]] += 1
         return most_freq
     elif words:
         # No known words from our training set, return random one, last one might be cut-off though so ignore that one
-        index_dict[replace_types[3]] += 1
+        stats[index_replace_types[3]] += 1
         rand_return = random.choice(words[0:-1]) if len(words) > 1 else random.choice(words)
         return rand_return
     else:
         # If all else fails just return person
-        index_dict[replace_types[4]] += 1
+        stats[index_replace_types[4]] += 1
         return 'person'
 
 
-def get_most_frequent_referent(seen_coref, ref_dict, tok_line):
-    '''Takes care of indexes that were never instantiated'''
-
+def rank_referents(seen_coref, ref_dict, index_counts):
+    '''Rank the instantiated referents for indexes that were never instantiated. Returns the replace type
+       and the referent, the referent is None if we have to pick a random one'''
     # First check if we have instantiated variables that were never referred to
-    line = " ".join(tok_line)
     most_freq = ''
     score = -1
 
     for item in seen_coref:
         # Index only occurs once - never used as reference
-        if line.count(item) == 1:
+        if index_counts[item] == 1:
             # If this word in general dict, check if it is the most frequent
             if seen_coref[item] in ref_dict:
                 if ref_dict[seen_coref[item]] > score:
@@ -403,28 +449,27 @@ def get_most_frequent_referent(seen_coref, ref_dict, tok_line):
 
     # If we found once, return that one
     if score > -1:
-        index_dict[replace_types[1]] += 1
-        return most_freq
+        return index_replace_types[1], most_freq
+
     # Else find the most frequent in general
-    else:
-        most_freq = ''
-        score = -1
-        # If this word in general dict, check if it is the most frequent
-        for item in seen_coref:
-            if seen_coref[item] in ref_dict:
-                if ref_dict[seen_coref[item]] > score:
-                    score = ref_dict[seen_coref[item]]
-                    most_freq = seen_coref[item]
+    # If this word in general dict, check if it is the most frequent
+    for item in seen_coref:
+        if seen_coref[item] in ref_dict:
+            if ref_dict[seen_coref[item]] > score:
+                score = ref_dict[seen_coref[item]]
+                most_freq = seen_coref[item]
+    return index_replace_types[2], most_freq if score > -1 else None
 
-        if score > -1:
-            # Return most frequent referent we saw
-            index_dict[replace_types[2]] += 1
-            return most_freq
-        else:
-            # If no referents with score, return a random one
-            index_dict[replace_types[2]] += 1
-            rand_key = random.choice(list(seen_coref.keys()))
-            return seen_coref[rand_key]
+
+def get_most_frequent_referent(referent_ranking, seen_coref, stats):
+    '''Takes care of indexes that were never instantiated'''
+    replace_type, referent = referent_ranking
+    stats[replace_type] += 1
+    if referent is None:
+        # If no referents with score, return a random one
+        rand_key = random.choice(list(seen_coref.keys()))
+        return seen_coref[rand_key]
+    return referent
 
 
 def add_coref(line):
@@ -437,7 +482,7 @@ def add_coref(line):
         # Variable in previous tok and value in tok afterwards
         if item == '/':
             if 'coref-' not in tok_line[idx+1]:
-                value = add_coref_instance(tok_line[idx+1:])
+                value = add_coref_instance(tok_line, idx + 1)
                 var_dict[value] = tok_line[idx-1]
 
     # Add back the coreference here
@@ -469,195 +514,129 @@ def add_coref(line):
 
 
 def preprocess_abs(line):
-    '''Put in such a format that restoring still works'''
-    # First restore the general format we expect, make sure there are spaces
-    # between all our information carrying tokens
-    new_line = left_space_for_char(space_brackets_amr(line), ':')
-    new_line = " ".join(new_line.replace('}', ' } ').replace('{', ' { ').split())
-    new_line = re.sub(r'(\|[\d]+\|)', r' \1 ', new_line)
-    new_line = " ".join(new_line.split())
-
-    # Rewrite the absolute paths to coref links so we can restore the coreference later
-    # without the convert() function messing everything up
-    if '{' in new_line:
-        line_parts = []
-        coref_parts = []
-        coref = False
-        for item in new_line.split():
-            if item == '{':
-                # Add brackets to keep structure
-                line_parts.append('(')
-                coref = True
-            elif item == '}':
-                add_part = 'COREF*' + "*".join(coref_parts).replace(':', 'COLON')
-                line_parts.append(add_part)
-                line_parts.append(')')
-                coref = False
-                coref_parts = []
-            elif coref:
-                coref_parts.append(item)
+    '''Rewrite the absolute or relative paths to coref links so we can restore the coreference later
+       without the convert() function messing everything up. All tokens are already separated by normalize_line'''
+    line_parts = []
+    coref_parts = []
+    coref = False
+    for item in line.split():
+        if item == '{':
+            # Add brackets to keep structure
+            line_parts.append('(')
+            coref = True
+        elif item == '}':
+            add_part = 'COREF*' + "*".join(coref_parts).replace(':', 'COLON')
+            line_parts.append(add_part)
+            line_parts.append(')')
+            coref = False
+            coref_parts = []
+        elif coref:
+            coref_parts.append(item)
+        else:
+            line_parts.append(item)
+    return " ".join(line_parts)
+
+
+def replace_absolute_paths(line, ref_dict, stats, relative=False):
+    '''Replace absolute (or relative) paths by the correct variable referent, the paths are added to stats
+       The AMR is parsed once to a trie of paths, every reference is then a walk down this trie'''
+    try:
+        root = parse_amr_tree(line)
+    except ValueError:
+        # We can not walk the paths, but the COREF tokens should not end up in the output
+        return remove_coref_tokens(line)
+    trie = build_path_trie(root)
+    concept_dict = {}
+    get_concepts(root, concept_dict)
+    replace_coref_nodes(root, [trie], concept_dict, ref_dict, stats, relative)
+    return amr_tree_to_string(root)
+
+
+def build_path_trie(node):
+    '''Return trie for the paths below this node: (relation, occurrence index) keys lead to the trie of that child,
+       key None holds the variable of the node. Coreference nodes and constants can not be a referent'''
+    trie = {None: None if node.concept.startswith('COREF*') else node.var}
+    rel_counts = Counter()
+    for rel, child in node.children:
+        rel_counts[rel] += 1
+        if isinstance(child, AMRNode):
+            trie[(rel, rel_counts[rel])] = build_path_trie(child)
+    return trie
+
+
+def replace_coref_nodes(node, ancestors, concept_dict, ref_dict, stats, relative):
+    '''Replace the COREF nodes below node by their referent, or remove them if there is no referent at all
+       ancestors contains the tries from the root down to the trie of node'''
+    new_children = []
+    rel_counts = Counter()
+    for rel, child in node.children:
+        rel_counts[rel] += 1
+        if isinstance(child, AMRNode):
+            if child.concept.startswith('COREF*'):
+                child = find_replacement(child.concept, ancestors, concept_dict, ref_dict, stats, relative)
+                if not child:
+                    continue
             else:
-                line_parts.append(item)
-        return " ".join(line_parts)
-    else:
-        return line
-
-
-def replace_absolute_paths(line, ref_dict):
-    '''Replace absolute paths by the correct variable referent'''
-    # Put line in format we expect
-    spl_line = tokenize_line(line).split()
-    new_line = line
-
-    # Loop over line and find the replacement for the coreference items
-    for idx, item in enumerate(spl_line):
-        if 'COREF*' in item:
-            # Find actual replacement here
-            repl = find_replacement(line, item, ref_dict)
-            if repl:
-                # Replace this part with the reference
-                to_be_replaced = " ".join(spl_line[idx-3:idx+2])
+                replace_coref_nodes(child, ancestors + [ancestors[-1][(rel, rel_counts[rel])]], concept_dict, ref_dict, stats, relative)
+        elif 'COREF*' in child:
+            # The brackets of the path got lost: a value that is only a (non-empty) path is replaced,
+            # otherwise the path is removed
+            value = child.strip('"')
+            if coref_token_re.fullmatch(value) and value != 'COREF*':
+                child = find_replacement(value, ancestors, concept_dict, ref_dict, stats, relative)
             else:
-                # Remove reference, so also include the argument
-                to_be_replaced = " ".join(spl_line[idx-4:idx+2])
+                value = " ".join(coref_token_re.sub('', value).split())
+                child = '"{0}"'.format(value) if child.startswith('"') else value
+            if not child.strip('"'):
+                continue
+        new_children.append([rel, child])
+    node.children = new_children
 
-            new_line = tokenize_line(new_line)
-            # Do actual replacement here (adding coreference)
-            new_line = new_line.replace(to_be_replaced, repl)
-    return reverse_tokenize(new_line)
 
+def remove_coref_tokens(line):
+    '''Remove the COREF tokens that could not be replaced by a referent, with their relation if they have one'''
+    return coref_edge_re.sub('', line) if 'COREF*' in line else line
 
-def find_replacement(line, item, ref_dict):
-    '''Find variable replacement for the path described in the output'''
-    line = " ".join(space_brackets_amr(line).split())
 
+def find_replacement(item, ancestors, concept_dict, ref_dict, stats, relative):
+    '''Find variable replacement for the path described in the output
+       Absolute paths start at the root, relative paths go up a node for each ^ first'''
     # We made temporary changes before as to not mess up the AMR, put those back first
     path = item.replace('COREF', '').replace('COLON', ':').replace('*', ' ').strip()
 
-    # Differentiate between arguments and number of arguments
-    args = [x for idx, x in enumerate(path.split()) if idx % 2 == 0]
-    num = [x for idx, x in enumerate(path.split()) if idx % 2 != 0]
-    nums = [int(x.replace('|', '').strip()) for x in num]
-
-    # Find the concepts in this AMR
-    concept_dict = get_concepts(line)
-
-    # Remove non-arguments that have a colon such as timestamps and websites
-    tok_line = " ".join(line.split())
-    new_parts = filter_colons(tok_line)
-
-    # Find the part we have to search
-    _, search_part = get_keep_string(new_parts, 0)
-
-    # Check if we found a correct path for this AMR
-    path_found, search_part = possible_path(args, nums, search_part)
+    # Differentiate between arguments and number of arguments, then walk down the trie
+    spl = path.split()
+    if relative:
+        ups = 0
+        while ups < len(spl) and spl[ups] == '^':
+            ups += 1
+        trie = ancestors[-1 - ups] if ups < len(ancestors) else None
+        spl = spl[ups:]
+    else:
+        trie = ancestors[0]
+    for rel, num in zip(spl[0::2], spl[1::2]):
+        if trie is None:
+            break
+        num = num.replace('|', '').strip()
+        trie = trie.get((rel, int(num))) if num.isdigit() else None
 
     # If we found correct path, return it
-    if path_found:
-        index_dict[replace_types[0]].append(path)
-        return get_reference(search_part)
+    if trie and trie[None]:
+        stats[path_replace_types[0]].append(path)
+        return trie[None]
     # Else return the variable the is most frequently a referent in the training set (default)
     else:
-        index_dict[replace_types[1]].append(path)
+        stats[path_replace_types[1]].append(path)
         return most_frequent_var(concept_dict, ref_dict)
 
 
-def get_path_to_search(search_part):
-    '''Find the path that we will search for this AMR'''
-    add_str, cur_rel, prev_rel, add_cur_rel, start_adding = '', '', '', False, False
-
-    for ch in search_part:
-        if ch == ':':
-            add_cur_rel = True
-            cur_rel = ':'
-            if start_adding:
-                add_str += ch
-        elif ch == '(':
-            start_adding = True
-            add_str += ch
-        elif start_adding:
-            add_str += ch
-        elif ch == ' ':
-            prev_rel = cur_rel
-            cur_rel = ''
-            add_cur_rel = False
-        elif add_cur_rel:
-            cur_rel += ch
-    return prev_rel + ' ' + add_str
-
-
-def get_permutations_by_string(search_part, level):
-    '''Get the initial permutations and add_string'''
-
-    paren_count = 0
-    start_adding = False
-    permutations = []
-    add_string = ''
-
-    if level > 0:
-        search_part = ':' + ":".join(search_part.split(':')[2:])
-        search_part = get_path_to_search(search_part)
-
-    # Make sure to handle some special cases
-    num_pattern = re.compile(r':[a-zA-Z0-9]+[ ]+(-\d+|\d+|imperative|interrogative|expressive|-)')
-    li_pattern = re.compile(r':li+[ ]+"[A-Za-z-0-9]+"')
-
-    # Remove double spaces from search part
-    search_part = " ".join(search_part.split())
-
-    for idx, ch in enumerate(search_part):
-        if ch == '(':
-            if start_adding:
-                add_string += ch
-            paren_count += 1
-        elif ch == ':':
-            start_adding = True
-            add_string += ch
-        elif ch == ')':
-            paren_count -= 1
-            if start_adding:
-                add_string += ch
-            if paren_count == 0:
-                permutations.append(add_string.strip())
-                add_string = ''
-        elif start_adding:
-            add_string += ch
-        # Special case, numbers such as :li 2 and :quant 300 mess everything up, or :mode imperative
-        if idx != len(search_part) -1 and (num_pattern.match(add_string.strip()) or li_pattern.match(add_string.strip())) and not search_part[idx+1].isdigit():
-            # Then just add permutation now already and continue
-            permutations.append(add_string.strip())
-            add_string = ''
-
-    # Check the final string we have left as well
-    if add_string and ':' in add_string:
-        permutations.append(add_string.replace(')', '').strip())
-        for idx, p in enumerate(permutations):
-            while permutations[idx].count(')') < permutations[idx].count('('):
-                permutations[idx] += ')'
-
-
-    # Permute without brackets (e.g. :op1 "name1" :op2 "name2" :op3 "name3"
-    for p in permutations:
-        if ')' not in p or '(' not in p:
-            if p.count(':') > 2:
-                p_split = p.split(':')[1:]
-                new_perms = [':' + x.strip() for x in p_split]
-                return add_string, new_perms
-
-    return add_string, permutations
-
-
-def get_concepts(line):
-    '''Function that returns AMR concepts while restoring for the paths method'''
-    line = " ".join(line.split())
-    _, var_dict = process_var_line(line, {})
-
-    for key in var_dict:
-        spl = var_dict[key].split()
-        if spl[-1].startswith(':'):
-            # Solve problems with everything being in one line, e.g. change concept :ARG1 to just concept
-            var_dict[key] = " ".join(spl[0:-1])
-    return var_dict
+def get_concepts(node, concept_dict):
+    '''Save the concepts of the variables in the AMR that can be a referent (for the paths method)'''
+    if not node.concept.startswith('COREF*'):
+        concept_dict[node.var] = node.concept
+    for _, child in node.children:
+        if isinstance(child, AMRNode):
+            get_concepts(child, concept_dict)
 
 
 def restore_rewrites(line):
@@ -669,45 +648,12 @@ def restore_rewrites(line):
     line = re.sub(r' ([\d])+ :([\d]+)', r'\1:\2', line)
     return line
 
-def possible_path(args, nums, search_part):
-    '''Function that returns whether it is possible to follow the path to a referent'''
-    path_found = True
-    for idx in range(0, len(args)):
-        _, permutations = get_permutations_by_string(search_part, idx)
-        # Check if the output path matches with a path in the AMR
-        search_part = matching_perm(permutations, args[idx], nums[idx])
-        if not search_part:
-            # Did not find a correct path
-            path_found = False
-            break
-    return path_found, search_part
-
-
-def matching_perm(permutations, rel, count):
-    '''Check if the current path value matches a possible path in the AMR'''
-    num_matches, matching_perm = 0, ''
-    for p in permutations:
-        rel_p = p.split()[0]
-        if rel_p == rel:
-            num_matches += 1
-            if num_matches == count:
-                matching_perm = p
-    return matching_perm
-
-
-def get_reference(search_part):
-    '''Get the correct reference'''
-    spl_line = search_part.split()
-    for idx, part in enumerate(spl_line):
-        if part == '/':
-            ref_var = spl_line[idx-1]
-            break
-    return ref_var.replace('(', '')
-
-
 def most_frequent_var(concept_dict, ref_dict):
     '''Get the variable in AMR that is most frequent in training set, based on dictionary of concepts'''
     most_freq, score = '', -1
+    if not concept_dict:
+        return ''
+
     for item in concept_dict:
         if concept_dict[item] in ref_dict:
             if ref_dict[concept_dict[item]] > score:
@@ -721,87 +667,185 @@ def most_frequent_var(concept_dict, ref_dict):
         return most_freq
 
 
-def print_coref_stats(coreference, replace_types, index_dict):
-    '''Print some statistics of how we handled coreference (for indexing and absolute method)'''
+def path_steps(path):
+    '''Number of steps in a path, a step is either a relation with its index or a ^ (for relative paths)'''
+    return (len(path.split()) + path.count('^')) / 2
+
+
+def print_coref_stats(coreference, stats):
+    '''Print some statistics of how we handled coreference (for indexing and paths method)
+       For relative paths each ^ counts as a step as well'''
     if coreference == 'index':
         print('Results for types of replacements:\n')
-        for key in replace_types:
-            print('{0}: {1}'.format(key, index_dict[key]))
-    elif coreference == 'abs':
+        for key in stats:
+            print('{0}: {1}'.format(key, stats[key]))
+    elif coreference in ['abs', 'rel']:
         for idx in range(1, 4):
-            for key in replace_types:
+            for key in stats:
                 # Only get paths of certain length
-                cur_paths = [x for x in index_dict[key] if (len(x.split()) / 2) == idx]
+                cur_paths = [x for x in stats[key] if path_steps(x) == idx]
                 print(key)
                 print('Len cur_paths: {0} for idx {1}\n'.format(len(cur_paths), idx))
         # All paths
-        for key in replace_types:
-            cur_paths = [x for x in index_dict[key] if (len(x.split()) / 2) > 0]
+        for key in stats:
+            cur_paths = [x for x in stats[key] if path_steps(x) > 0]
             print(key)
             print('Len cur_paths: {0} for idx {1}\n'.format(len(cur_paths), 0))
         # All longer paths
-        for key in replace_types:
-            cur_paths = [x for x in index_dict[key] if (len(x.split()) / 2) > 3]
+        for key in stats:
+            cur_paths = [x for x in stats[key] if path_steps(x) > 3]
             print(key)
             print('Len cur_paths: {0} for idx {1}\n'.format(len(cur_paths), '>3'))
 
-if __name__ == '__main__':
-    args = create_arg_parser()
-    # Check parser arguments and load reference dict
-    ref_dict, index_dict, replace_types = initial_check(args.coreference, args.ref_dict)
-    restored_lines = []
-
-    global ggg
-    ggg = 0
-
-    # Loop over all AMRs in a file (one per line!)
-    for idx, line in enumerate(open(args.input_file, 'r')):
-        ggg += 1
-        # Initial preprocessing, absolute paths has extra preprocessing
-        line = preprocess(line, args.coreference)
-
-        # Make sure char and word-level are in a similar representation now
-        line = reverse_tokenize(tokenize_line(line))
+def restore_line(line, amr_id, coreference, ref_dict, stats, return_repairs=False):
+    '''Restore variables (and coreference for index/abs/rel) for a single one-line AMR, how the coreference
+       was restored is added to stats. Optionally also return the number of fixes the restoring needed'''
+    # Initial preprocessing and fixing in a single scan, absolute paths has extra preprocessing
+    line = normalize_line(line, coreference)
 
-        # Do some extra steps to fix some easy to fix problems
-        line = do_extra_steps(line)
+    # Restore coref indexing here
+    # We first rewrite them to a format that convert() can handle,
+    # final format is restored later
+    if coreference == 'index':
+        line = restore_coref_indexing(line, ref_dict, stats)
 
-        # Restore coref indexing here
-        # We first rewrite them to a format that convert() can handle,
-        # final format is restored later
-        if args.coreference == 'index':
-            line = restore_coref_indexing(line, ref_dict)
+    # Output of neural models can have non-finished edges, remove
+    line = remove_dangling_edges(line)
 
-        # Output of neural models can have non-finished edges, remove
-        line = remove_dangling_edges(line)
+    # Restore variables here, also fix problems afterwards if there are any
+    line, repairs = convert(line, amr_id, return_repairs=True)
 
-        # Extra step to make sure digits are not added to arguments
-        line = add_space_when_digit(line)
+    # We did some hacky rewrites to make sure convert() didn't mess anything up
+    # restore them in this step (polarity +, polite, etc)
+    line = restore_rewrites(line)
 
-        # Restore variables here, also fix problems afterwards if there are any
-        line = convert(line)
+    # Finally restore the coreference
+    if coreference == 'index':
+         # Replace the 'coref-' nodes with the reference
+        line = add_coref(line)
+    elif coreference in ['abs', 'rel']:
+        # Replace absolute or relative paths with reference here
+        line = replace_absolute_paths(line, ref_dict, stats, relative=coreference == 'rel')
+    line = " ".join(line.strip().split())
+    return (line, repairs) if return_repairs else line
+
+
+def postprocess_line(line, amr_id, coreference, ref_dict, stats):
+    '''Do the full postprocessing for a single AMR: restore, prune and restore duplicate coreference
+       Invalid AMRs are replaced by the default AMR, just as in postprocess_AMRs.py'''
+    line = restore_line(line, amr_id, coreference, ref_dict, stats)
+    if not valid_amr(line):
+        return get_default_amr()
+    line, _ = prune_amrs.prune_amr(line)
+    # Coreference restoring we only do for duplicating
+    if coreference == 'dupl':
+        line = restore_duplicate_coref.restore_coref(line).replace('_ (', '_(').replace(') "', ')"')
+    return line if valid_amr(line) else get_default_amr()
+
+
+def postprocess_lines(lines, coreference, ref_dict):
+    '''Postprocess a list of (amr_id, line) pairs, returns the AMRs and the coreference statistics of these lines'''
+    stats = new_coref_stats(coreference)
+    return [postprocess_line(line, amr_id, coreference, ref_dict, stats) for amr_id, line in lines], stats
+
+
+def postprocess_batch(input_list):
+    '''Worker function for the daemon, postprocess a chunk of (amr_id, line) pairs with the ref dict of init_worker'''
+    lines, coreference = input_list
+    return postprocess_lines(lines, coreference, worker_ref_dict)
+
+
+def restore_n_best(input_list):
+    '''Restore the n-best hypotheses of a sentence in order and stop at the first valid AMR that needed no fixes
+       Otherwise return the valid AMR that needed the fewest fixes, or the restored top hypothesis if none is valid
+       Worker function: uses the ref dict of init_worker, returns the AMR and the coreference statistics of the
+       returned hypothesis'''
+    hypotheses, amr_id, coreference = input_list
+    best, best_repairs, best_stats = None, None, None
+    for hyp in hypotheses:
+        stats = new_coref_stats(coreference)
+        line, repairs = restore_line(hyp, amr_id, coreference, worker_ref_dict, stats, return_repairs=True)
+        if valid_amr(line):
+            if not repairs:
+                return line, stats
+            if best is None or repairs < best_repairs:
+                best, best_repairs, best_stats = line, repairs, stats
+    if best is not None:
+        return best, best_stats
+    stats = new_coref_stats(coreference)
+    return restore_line(hypotheses[0], amr_id, coreference, worker_ref_dict, stats), stats
+
+
+def get_request_handler(coreference, ref_dict, pool, workers):
+    '''Return a request handler that postprocesses the AMRs in the body of a POST request
+       Every request has its own coreference statistics, the handler threads share no state'''
+    class RestoreHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            lines = [(idx + 1, line) for idx, line in enumerate(body.split('\n')) if line.strip()]
+            # Single AMRs are handled in this thread, batches are spread over the workers
+            if len(lines) < 2 * workers:
+                amrs, _ = postprocess_lines(lines, coreference, ref_dict)
+            else:
+                size = (len(lines) + workers - 1) // workers
+                chunks = [[lines[i:i + size], coreference] for i in range(0, len(lines), size)]
+                amrs = [amr for chunk, _ in pool.map(postprocess_batch, chunks) for amr in chunk]
+            response = ("\n".join(amrs) + '\n').encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+        def log_message(self, *args):
+            pass
+    return RestoreHandler
+
+
+def serve(port, coreference, ref_dict, workers):
+    '''Run the restoring daemon on localhost, the workers get the ref dict when they start'''
+    pool = Pool(processes=workers, initializer=init_worker, initargs=(ref_dict,))
+    server = ThreadingHTTPServer(('localhost', port), get_request_handler(coreference, ref_dict, pool, workers))
+    print('Serving AMR restoring on localhost:{0} with {1} workers'.format(port, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.terminate()
 
-        # The digit problem might reoccur again here
-        line = add_space_when_digit(line)
 
-        # We did some hacky rewrites to make sure convert() didn't mess anything up
-        # restore them in this step (polarity +, polite, etc)
-        line = restore_rewrites(line)
+if __name__ == '__main__':
+    args = create_arg_parser()
+    # Check parser arguments and load reference dict
+    ref_dict, coref_stats = initial_check(args.coreference, args.ref_dict)
 
-        # Finally restore the coreference
-        if args.coreference == 'index':
-             # Replace the 'coref-' nodes with the reference
-            line = add_coref(line)
-        elif args.coreference == 'abs':
-            # Replace absolute paths with reference here
-            line = replace_absolute_paths(line, ref_dict)
+    # Daemon mode: keep everything loaded and restore AMRs on request
+    if args.serve:
+        serve(args.serve, args.coreference, ref_dict, args.workers)
+        sys.exit(0)
 
-        # Save the final line
-        restored_lines.append(" ".join(line.strip().split()))
+    # Loop over all AMRs in a file (one per line!)
+    if args.n_best == 1:
+        restored_lines = [restore_line(line, idx + 1, args.coreference, ref_dict, coref_stats) for idx, line in enumerate(open(args.input_file, 'r'))]
+    else:
+        # Group the hypotheses per sentence and restore the sentences in parallel
+        lines = [line for line in open(args.input_file, 'r')]
+        if len(lines) % args.n_best:
+            raise ValueError('Number of lines in {0} is not a multiple of --n_best {1}'.format(args.input_file, args.n_best))
+        sentences = [[lines[i:i + args.n_best], i // args.n_best + 1, args.coreference] for i in range(0, len(lines), args.n_best)]
+        pool = Pool(processes=args.workers, initializer=init_worker, initargs=(ref_dict,))
+        restored_lines = []
+        # The workers return their statistics, their own copies of the dicts are not seen here
+        for line, stats in pool.map(restore_n_best, sentences, chunksize=16):
+            restored_lines.append(line)
+            merge_coref_stats(coref_stats, stats)
+        pool.close()
 
     # Print detailed results for the coreference methods
     if args.print_stats:
-        print_coref_stats(args.coreference, replace_types, index_dict)
+        print_coref_stats(args.coreference, coref_stats)
 
     # Write final output to file
     write_to_file(restored_lines, args.output_file)
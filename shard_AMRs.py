@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+'''Script that splits a file (e.g. a .char.sent file) in shards that can be decoded in parallel, and merges the output
+   of the shards back in the original order
+
+   The lines are divided by their total length (number of tokens) instead of the number of lines, so the shards take
+   about the same time to decode. The order within a shard stays the same. The shard of each line is written to a
+   shard map, which is used to merge the output again. The shards of /folder/file.char.sent are called
+   /folder/file_shard0.char.sent, /folder/file_shard1.char.sent etc, the shard map is /folder/file.shard_map
+   The first line of the shard map lists the extensions of the split files, so postprocess_AMRs.py can find the
+   sentence shards (e.g. .txt.sent for /folder/file.txt.sent)
+
+   Split in 4 shards (the sentence file is split the same way, needed for Wikification):
+
+   python shard_AMRs.py -f data/file.char.sent -n 4 -p data/file.sent
+
+   Merge the post-processed output of the shards to data/file.seq.amr.restore.final:
+
+   python shard_AMRs.py -f data/file.shard_map -m .seq.amr.restore.final'''
+
+
+import os
+import heapq
+import argparse
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--input_file', required=True, type=str, help="File to split, or the shard map when merging (-m)")
+    parser.add_argument('-n', '--num_shards', default=4, type=int, help="Number of shards (default 4)")
+    parser.add_argument('-p', '--parallel_files', default=[], nargs='*', help="Files that are split in the same way as -f, e.g. the sentence file for Wikification")
+    parser.add_argument('-m', '--merge', default='', type=str, help="Merge the shard files with this extension in the original order, e.g. .seq.amr.restore.final (-f is the shard map)")
+    args = parser.parse_args()
+    return args
+
+
+map_ext = '.shard_map'
+
+
+def split_name(input_file):
+    '''Split a file name in the name without extensions and the extensions: /folder/file.char.sent gives
+       /folder/file and .char.sent'''
+    folder, name = os.path.split(input_file)
+    base, dot, ext = name.partition('.')
+    return os.path.join(folder, base), dot + ext
+
+
+def shard_name(base, shard, ext):
+    '''Name of a shard file, e.g. /folder/file_shard0.char.sent'''
+    return '{0}_shard{1}{2}'.format(base, shard, ext)
+
+
+def read_shard_map(map_file):
+    '''Return the shard of each line from the shard map'''
+    return [int(line) for line in open(map_file, 'r') if not line.startswith('#')]
+
+
+def read_shard_exts(map_file):
+    '''Return the extensions of the split files from the first line of the shard map, the file that was
+       split (-f) comes first. Shard maps without this line give an empty list'''
+    with open(map_file, 'r') as in_f:
+        first_line = in_f.readline()
+    return first_line[1:].split() if first_line.startswith('#') else []
+
+
+def balance_shards(lengths, num_shards):
+    '''Divide the lines over the shards so that the total lengths are as equal as possible: the longest lines are
+       divided first, each line goes to the shard with the lowest total so far. Returns the shard of each line'''
+    heap = [(0, shard) for shard in range(num_shards)]
+    shards = [0] * len(lengths)
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        total, shard = heapq.heappop(heap)
+        shards[idx] = shard
+        heapq.heappush(heap, (total + lengths[idx], shard))
+    return shards
+
+
+def split_by_map(input_file, shards, num_shards):
+    '''Write each line of input_file to the file of its shard'''
+    base, ext = split_name(input_file)
+    out_files = [open(shard_name(base, shard, ext), 'w') for shard in range(num_shards)]
+    num_lines = 0
+    for idx, line in enumerate(open(input_file, 'r')):
+        if idx >= len(shards):
+            raise ValueError('{0} has more lines than the shard map ({1})'.format(input_file, len(shards)))
+        out_files[shards[idx]].write(line.rstrip('\n') + '\n')
+        num_lines += 1
+    for out_f in out_files:
+        out_f.close()
+    if num_lines != len(shards):
+        raise ValueError('{0} has {1} lines, the shard map has {2}'.format(input_file, num_lines, len(shards)))
+
+
+def shard_file(input_file, num_shards, parallel_files):
+    '''Split input_file (and the parallel files) in num_shards shards of about equal total length and write the shard map'''
+    lengths = [len(line.split()) for line in open(input_file, 'r')]
+    shards = balance_shards(lengths, num_shards)
+    base, _ = split_name(input_file)
+    with open(base + map_ext, 'w') as out_f:
+        out_f.write('# ' + ' '.join(split_name(in_file)[1] for in_file in [input_file] + parallel_files) + '\n')
+        for shard in shards:
+            out_f.write(str(shard) + '\n')
+
+    for in_file in [input_file] + parallel_files:
+        split_by_map(in_file, shards, num_shards)
+
+    # Show how well the shards are balanced
+    totals, num_lines = [0] * num_shards, [0] * num_shards
+    for shard, length in zip(shards, lengths):
+        totals[shard] += length
+        num_lines[shard] += 1
+    for shard in range(num_shards):
+        print('{0}: {1} lines, {2} tokens'.format(shard_name(base, shard, split_name(input_file)[1]), num_lines[shard], totals[shard]))
+    print('Wrote shard map to {0}'.format(base + map_ext))
+
+
+def merge_shards(map_file, ext):
+    '''Merge the shard files with extension ext in the original order of the lines, the shards are read line by line'''
+    base = map_file[:-len(map_ext)] if map_file.endswith(map_ext) else map_file
+    out_file = base + ext
+    in_files = {}
+    with open(out_file, 'w') as out_f:
+        for line in open(map_file, 'r'):
+            if line.startswith('#'):
+                continue
+            shard = int(line)
+            if shard not in in_files:
+                in_files[shard] = open(shard_name(base, shard, ext), 'r')
+            shard_line = in_files[shard].readline()
+            if not shard_line:
+                raise ValueError('{0} has fewer lines than the shard map'.format(shard_name(base, shard, ext)))
+            out_f.write(shard_line.rstrip('\n') + '\n')
+
+    for shard, in_f in in_files.items():
+        if in_f.readline():
+            raise ValueError('{0} has more lines than the shard map'.format(shard_name(base, shard, ext)))
+        in_f.close()
+    print('Merged {0} shards to {1}'.format(len(in_files), out_file))
+    return out_file
+
+
+if __name__ == "__main__":
+    args = create_arg_parser()
+    if args.merge:
+        merge_shards(args.input_file, args.merge)
+    else:
+        shard_file(args.input_file, args.num_shards, args.parallel_files)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+'''Script that puts AMR and sentence files in subword (BPE) format, as an alternative to char-level and word-level
+   Merges are learned on the words of the .tf and .sent files together (byte pair encoding, Sennrich et al., 2016)
+   Relations, brackets, quoted strings and coreference markers (|1|, *1*, {, }, ^) are never split or merged
+
+   Input should be one AMR or sentence per line. Subwords that continue in the next token end with @@,
+   restoreAMR/restore_amr.py removes those again (no extra option needed)
+
+   Sample input (AMR file):
+
+   (establish-01 :ARG1 (model :mod (innovate-01 :ARG1 (industry))))
+
+   Sample output (AMR file):
+
+   ( establish-01 :ARG1 ( mo@@ de@@ l :mod ( innovate-01 :ARG1 ( industry ) ) ) )'''
+
+
+import os
+import sys
+import re
+import heapq
+import argparse
+from collections import Counter, defaultdict
+from amr_utils import write_to_file, get_files_by_ext, process_folder
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--input_file', required=True, type=str, help="Input AMR/sentence file or folder")
+    parser.add_argument('-fol', '--folder', action='store_true', help='Add to do multiple files in a folder - if not, args.f is a file')
+    parser.add_argument('-sen', "--sent_ext", default='.sent', type=str, help="Extension of sentence files (default .sent)")
+    parser.add_argument('-a', '--amr_ext', default='.tf', type=str, help="Extension of AMR files (default .tf)")
+    parser.add_argument('-c', '--codes', required=True, type=str, help="File with the BPE merges, one pair per line")
+    parser.add_argument('-l', '--learn', action='store_true', help='Learn the merges on the input first and write them to the codes file')
+    parser.add_argument('-m', '--merges', default=10000, type=int, help="Number of merges to learn (default 10000)")
+    parser.add_argument('-mf', '--min_freq', default=2, type=int, help="Stop learning when the most frequent pair occurs less often (default 2)")
+    parser.add_argument('-t', '--threads', default=16, type=int, help="Number of files processed in parallel when using -fol (default 16)")
+    args = parser.parse_args()
+    return args
+
+
+# Quoted strings without spaces (which might contain brackets) are a single word, other brackets are separate tokens
+token_re = re.compile(r'"[^"\s]*"|[()]|[^\s()]+')
+# Tokens that are kept as they are: relations, brackets, quoted strings and coreference markers
+atomic_re = re.compile(r':\S+|[(){}^]|"[^"]*"|\|\d+\||\*\d+\*')
+end_of_word = '</w>'
+
+
+def tokenize(line):
+    '''Split a line in tokens, brackets are separate tokens unless they are between quotes'''
+    return token_re.findall(line)
+
+
+def is_atomic(token):
+    '''Tokens that are never split in subwords'''
+    return atomic_re.fullmatch(token) is not None
+
+
+def count_words(files):
+    '''Count the words (tokens that are not atomic) of all files'''
+    word_counts = Counter()
+    for input_file in files:
+        for line in open(input_file, 'r'):
+            word_counts.update(tok for tok in tokenize(line) if not is_atomic(tok))
+    return word_counts
+
+
+def learn_bpe(word_counts, num_merges, min_freq):
+    '''Learn the BPE merges: repeatedly merge the most frequent pair of symbols
+       The pair counts are updated for the words that contain the merged pair only, a heap gives the most frequent pair'''
+    words = [list(word[:-1]) + [word[-1] + end_of_word] for word in word_counts]
+    freqs = list(word_counts.values())
+    stats = Counter()
+    indices = defaultdict(set)
+    for idx, word in enumerate(words):
+        for pair in zip(word, word[1:]):
+            stats[pair] += freqs[idx]
+            indices[pair].add(idx)
+    heap = [(-freq, pair) for pair, freq in stats.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_merges:
+        freq, pair = heapq.heappop(heap)
+        # Skip outdated heap entries, the count of the pair changed after it was added
+        if -freq != stats.get(pair, 0):
+            continue
+        if -freq < min_freq:
+            break
+        merges.append(pair)
+        changed = set()
+        for idx in indices.pop(pair):
+            word = words[idx]
+            new_word = merge_pair(word, pair)
+            if new_word == word:
+                continue
+            # Remove the pairs of the old word and add the pairs of the new word
+            for old_pair in zip(word, word[1:]):
+                stats[old_pair] -= freqs[idx]
+                changed.add(old_pair)
+            for new_pair in zip(new_word, new_word[1:]):
+                stats[new_pair] += freqs[idx]
+                indices[new_pair].add(idx)
+                changed.add(new_pair)
+            words[idx] = new_word
+        del stats[pair]
+        for changed_pair in changed:
+            if stats.get(changed_pair, 0) > 0:
+                heapq.heappush(heap, (-stats[changed_pair], changed_pair))
+    return merges
+
+
+def merge_pair(symbols, pair):
+    '''Merge all occurrences of pair in the list of symbols'''
+    new_symbols, idx = [], 0
+    while idx < len(symbols):
+        if idx < len(symbols) - 1 and (symbols[idx], symbols[idx+1]) == pair:
+            new_symbols.append(symbols[idx] + symbols[idx+1])
+            idx += 2
+        else:
+            new_symbols.append(symbols[idx])
+            idx += 1
+    return new_symbols
+
+
+def load_codes(codes_file):
+    '''Load the merges, the rank of a merge is its line number'''
+    ranks = {}
+    for line in open(codes_file, 'r'):
+        spl = line.split()
+        if len(spl) == 2:
+            ranks.setdefault(tuple(spl), len(ranks))
+    return ranks
+
+
+def segment_word(word, ranks, cache):
+    '''Split a word in subwords by applying the merges in order of their rank'''
+    if word in cache:
+        return cache[word]
+    symbols = list(word[:-1]) + [word[-1] + end_of_word]
+    while len(symbols) > 1:
+        pair = min(zip(symbols, symbols[1:]), key=lambda p: ranks.get(p, len(ranks)))
+        if pair not in ranks:
+            break
+        symbols = merge_pair(symbols, pair)
+    # Mark the subwords that continue in the next one
+    subwords = [sym + '@@' for sym in symbols[:-1]] + [symbols[-1][:-len(end_of_word)]]
+    cache[word] = subwords
+    return subwords
+
+
+def subword_line(line, ranks, cache):
+    '''Put a single line in subword format, atomic tokens are kept as they are'''
+    new_tokens = []
+    for tok in tokenize(line):
+        if is_atomic(tok):
+            new_tokens.append(tok)
+        else:
+            new_tokens.extend(segment_word(tok, ranks, cache))
+    return " ".join(new_tokens)
+
+
+def file_ext(input_file, amr_ext, sent_ext):
+    '''Return the extension of an AMR or sentence file, other files are an error'''
+    for ext in (amr_ext, sent_ext):
+        if input_file.endswith(ext):
+            return ext
+    raise ValueError('{0} does not end with {1} or {2}'.format(input_file, amr_ext, sent_ext))
+
+
+def parallel_file(input_file, amr_ext, sent_ext):
+    '''Return the sentence file of an AMR file or the other way around'''
+    ext = file_ext(input_file, amr_ext, sent_ext)
+    return input_file[:-len(ext)] + (sent_ext if ext == amr_ext else amr_ext)
+
+
+def subword_file(input_file, codes_file, amr_ext, sent_ext):
+    '''Put a single AMR or sentence file in subword format, output gets .bpe before the extension'''
+    ext = file_ext(input_file, amr_ext, sent_ext)
+    # Output of a previous run also has the extension, skip it
+    if input_file.endswith('.bpe' + ext):
+        return
+    out_f = input_file[:-len(ext)] + '.bpe' + ext
+    ranks, cache = load_codes(codes_file), {}
+    write_to_file((subword_line(line, ranks, cache) for line in open(input_file, 'r')), out_f)
+
+
+if __name__ == '__main__':
+    args = create_arg_parser()
+    if args.folder:
+        files = sorted(get_files_by_ext(args.input_file, (args.amr_ext, args.sent_ext)))
+    else:
+        # Also learn on the parallel file of a single file, if it is there
+        other_file = parallel_file(args.input_file, args.amr_ext, args.sent_ext)
+        files = [args.input_file] + ([other_file] if os.path.isfile(other_file) else [])
+    files = [f for f in files if not f.endswith(('.bpe' + args.amr_ext, '.bpe' + args.sent_ext))]
+
+    if args.learn:
+        # Learn the merges on all files together, so AMRs and sentences share their subwords
+        merges = learn_bpe(count_words(files), args.merges, args.min_freq)
+        write_to_file([" ".join(pair) for pair in merges], args.codes)
+        print('Learned {0} merges from {1} files'.format(len(merges), len(files)))
+
+    if not args.folder:
+        subword_file(args.input_file, args.codes, args.amr_ext, args.sent_ext)
+    else:
+        process_folder(args.input_file, (args.amr_ext, args.sent_ext), subword_file, [args.codes, args.amr_ext, args.sent_ext], args.threads)
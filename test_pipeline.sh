@@ -36,6 +36,57 @@ test_pruning(){
 }
 
 
+# Test that decoding the char-level files gives back the input, for all char-level modes
+test_round_trip(){
+	printf "\n----------------------------------------------\n"
+	printf "Testing the char-level round-trip\n\n"
+	# char_level_AMR.py -r raises an error if a line does not decode to the input
+	tmp_dir=$(mktemp -d)
+	for coref in dupl abs index; do
+		if [[ $coref == "dupl" ]] ; then
+			python3 ${cur_dir}/var_free_amrs.py -f $TEST_FILE
+		elif [[ $coref == "index" ]] ; then
+			python3 ${cur_dir}/create_coref_indexing.py -f $TEST_FILE
+		else
+			python3 ${cur_dir}/create_coref_paths.py -f $TEST_FILE -p $coref
+		fi
+		cp ${TEST_FILE}.tf ${tmp_dir}/${coref}.tf
+		# Plain characters and super characters, paths (|1|) and indexes (*3*) need -c
+		python3 ${cur_dir}/char_level_AMR.py -c -r -f ${tmp_dir}/${coref}.tf
+		python3 ${cur_dir}/char_level_AMR.py -c -s -r -f ${tmp_dir}/${coref}.tf
+	done
+	cp $SENT_FILE ${tmp_dir}/sample.sent
+	python3 ${cur_dir}/char_level_AMR.py -r -f ${tmp_dir}/sample.sent
+	rm -r $tmp_dir
+}
+
+
+# Test that preprocess_AMRs.py gives the same char-level files as the separate scripts
+test_preprocess(){
+	printf "\n----------------------------------------------\n"
+	printf "Testing preprocess_AMRs.py against the separate scripts\n\n"
+	# Work on a copy, the .sent output would overwrite the sentence file of the sample
+	tmp_dir=$(mktemp -d)
+	cp $ALIGNED_FILE ${tmp_dir}/sample.txt
+	for rep in char super; do
+		super_chars="" #default, overwrite for super
+		if [[ $rep == "super" ]] ; then
+			super_chars="-s"
+		fi
+		python3 ${cur_dir}/preprocess_AMRs.py -f ${tmp_dir}/sample.txt -c abs
+		python3 ${cur_dir}/char_level_AMR.py $super_chars -c -f ${tmp_dir}/sample.txt.tf
+		python3 ${cur_dir}/char_level_AMR.py -f ${tmp_dir}/sample.txt.sent
+		for ext in tf sent; do
+			mv ${tmp_dir}/sample.txt.char.${ext} ${tmp_dir}/chained.char.${ext}
+		done
+		python3 ${cur_dir}/preprocess_AMRs.py -f ${tmp_dir}/sample.txt -c abs -rep $rep
+		cmp ${tmp_dir}/sample.txt.char.tf ${tmp_dir}/chained.char.tf
+		cmp ${tmp_dir}/sample.txt.char.sent ${tmp_dir}/chained.char.sent
+	done
+	rm -r $tmp_dir
+}
+
+
 # Test best AMR permutation
 test_best_permutation(){
 	printf "\n----------------------------------------------\n"
@@ -116,5 +167,7 @@ test_restore(){
 # Run tests here
 test_restore
 test_pruning
+test_round_trip
+test_preprocess
 test_best_permutation
 test_wikification
@@ -20,7 +20,9 @@ import sys
 import re
 import argparse
 import os
-from amr_utils import write_to_file, remove_char_outside_quotes
+from itertools import islice
+from multiprocessing import Pool
+from amr_utils import remove_char_outside_quotes, process_folder
 
 
 def create_args_parser():
@@ -31,6 +33,7 @@ def create_args_parser():
     parser.add_argument('-a', "--amr_ext", default='.txt', type=str, help="Input files must have this extension (default .txt, only necesary when using -fol)")
     parser.add_argument('-o', '--output_ext', default='.tf', help="extension of output AMR files (default .tf)")
     parser.add_argument('-k', '--keep_wiki', action='store_true', help='Keep Wiki link when processing')
+    parser.add_argument('-t', '--threads', default=16, type=int, help='Number of processes the AMRs of a file are divided over, or the number of files that are done in parallel when using -fol (default 16)')
     args = parser.parse_args()
     return args
 
@@ -38,40 +41,65 @@ def create_args_parser():
 def single_line_convert(lines, sent_file):
     '''Convert AMRs to a single line, ignoring lines that start with "# ::"
       If a sentence file is specified we also try to get the sentences'''
-    all_amrs, cur_amr, sents = [], [], []
+    sents = []
+    all_amrs = list(iter_single_line_amrs(lines, sents))
+
+    # If we didn't find sentences, but we did have a sentence file, read the sentences from there (if possible)
+    if not sents and sent_file:
+        if os.path.isfile(sent_file):
+            sents = [x.strip() for x in open(sent_file, 'r')]
+            # Sanity check
+            assert len(all_amrs) == len(sents), "{0} vs {1}".format(len(all_amrs), len(sents))
+    return all_amrs, sents
+
+
+def iter_single_line_amrs(lines, sents=None):
+    '''Yield the AMRs in lines one by one as a single line, so that files can be streamed
+       Sentences of "# ::snt" and "# ::tok" lines are added to sents, if given'''
+    cur_amr = []
     for line in lines:
         if not line.strip() and cur_amr:
             cur_amr_line = " ".join(cur_amr)
-            all_amrs.append(cur_amr_line.strip())
+            yield cur_amr_line.strip()
             cur_amr = []
         elif line.startswith('# ::snt') or line.startswith('# ::tok'):
             # Save sentences as well (don't always need them)
-            sent = re.sub('(^# ::(tok|snt))', '', line).strip() #remove # ::snt or # ::tok
-            sents.append(sent)
+            if sents is not None:
+                sent = re.sub('(^# ::(tok|snt))', '', line).strip() #remove # ::snt or # ::tok
+                sents.append(sent)
         elif not line.startswith('#'):
             cur_amr.append(line.strip())
     # File did not end with newline, so add AMR here
     if cur_amr:
-        all_amrs.append(" ".join(cur_amr).strip())
-
-    # If we didn't find sentences, but we did have a sentence file, read the sentences from there (if possible)
-    if not sents and sent_file:
-        if os.path.isfile(sent_file):
-            sents = [x.strip() for x in open(sent_file, 'r')]
-            # Sanity check
-            assert len(all_amrs) == len(sents), "{0} vs {1}".format(len(all_amrs), len(sents))
-    return all_amrs, sents
+        yield " ".join(cur_amr).strip()
 
 
 def delete_wiki(input_file):
     '''Delete wiki links from AMRs'''
-    no_wiki = []
+    return [delete_wiki_line(line) for line in open(input_file, 'r')]
+
+
+def delete_wiki_line(line):
+    '''Delete wiki link from a single line of an AMR'''
+    n_line = re.sub(r':wiki "(.*?)"', '', line, 1)
+    n_line = re.sub(':wiki -', '', n_line)
+    # Merge double whitespace but keep leading whitespace
+    return (len(n_line) - len(n_line.lstrip())) * ' ' + ' '.join(n_line.split())
+
+
+def read_amr_blocks(input_file):
+    '''Read a file with AMRs and yield the lines (including comments) of each AMR separately'''
+    block = []
     for line in open(input_file, 'r'):
-        n_line = re.sub(r':wiki "(.*?)"', '', line, 1)
-        n_line = re.sub(':wiki -', '', n_line)
-        # Merge double whitespace but keep leading whitespace
-        no_wiki.append((len(n_line) - len(n_line.lstrip())) * ' ' + ' '.join(n_line.split()))
-    return no_wiki
+        if not line.strip():
+            if block:
+                yield block
+                block = []
+        else:
+            block.append(line.rstrip())
+    # File did not end with newline
+    if block:
+        yield block
 
 
 def process_var_line(line, var_dict):
@@ -125,31 +153,45 @@ def process_var_line(line, var_dict):
 
 
 def delete_amr_variables(amrs):
-    '''Function that deletes variables from AMRs'''
-    full_var_dict = {}
+    '''Function that deletes variables from AMRs, the variables are looked up per AMR (separated by empty lines)'''
     del_amr = []
-
-    # First get the var dict
+    block = []
     for line in amrs:
-        _, full_var_dict = process_var_line(line, full_var_dict)
+        if line.strip():
+            block.append(line)
+        else:
+            del_amr += delete_block_variables(block) + [line]
+            block = []
+    return del_amr + delete_block_variables(block)
 
-    # Loop over AMRs to rewrite
-    for line in amrs:
-        if line.strip() and line[0] != '#':
+
+def delete_block_variables(block):
+    '''Delete the variables of a single AMR (list of lines), re-entrancies are replaced by the node they refer to'''
+    var_dict = {}
+    del_amr = []
+
+    # First get the var dict for this AMR
+    for line in block:
+        if line[0] != '#':
+            _, var_dict = process_var_line(line, var_dict)
+
+    # Loop over lines of the AMR to rewrite
+    for line in block:
+        if line[0] != '#':
             if '/' in line:
                 # Found variable here
                 # Get the deleted variable string and save
-                deleted_var_string, _ = process_var_line(line, full_var_dict)
+                deleted_var_string, _ = process_var_line(line, {})
                 del_amr.append(deleted_var_string)
             else:
                 # Probable reference to variable here!
                 split_line = line.split()
-                ref_var = split_line[1].replace(')', '')
+                ref_var = split_line[1].replace(')', '') if len(split_line) > 1 else ''
 
                 # Check if the variable occurs in our dictionary
-                if ref_var in full_var_dict:
+                if ref_var in var_dict:
                     # Get value to replace the variable name with
-                    ref_value = full_var_dict[ref_var]
+                    ref_value = var_dict[ref_var]
                     # Do the replacing and add brackets for alignment
                     split_line[1] = split_line[1].replace(ref_var, '(' + ref_value.strip() + ')')
                     n_line = (len(line) - len(line.lstrip())) * ' ' + " ".join(split_line)
@@ -163,15 +205,33 @@ def delete_amr_variables(amrs):
     return del_amr
 
 
-def var_free_amrs(input_file, out_ext, keep_wiki):
-    '''Create variable-free AMRs and sentence files'''
-    # Delete wiki link if wanted
-    amr_no_wiki = delete_wiki(input_file) if not keep_wiki else [x.rstrip() for x in open(input_file, 'r')]
+def var_free_amr(input_list):
+    '''Create a variable-free single-line AMR from the lines of an AMR, returns None if there was only a comment'''
+    block, keep_wiki = input_list
+    if not keep_wiki:
+        # Lines that only had a wiki link are empty now
+        block = [line for line in map(delete_wiki_line, block) if line.strip()]
     # Remove all variables by duplicating coreference nodes
-    del_amrs = delete_amr_variables(amr_no_wiki)
-    # Put AMR on single line and write output
-    single_amrs, _ = single_line_convert(del_amrs, '')
-    write_to_file(single_amrs, input_file + out_ext)
+    del_lines = delete_block_variables(block)
+    # Put AMR on single line
+    amr = " ".join(line.strip() for line in del_lines if not line.startswith('#')).strip()
+    return amr if amr else None
+
+
+def var_free_amrs(input_file, out_ext, keep_wiki, threads=1):
+    '''Create variable-free AMRs, one AMR at a time so memory use does not depend on the file size
+       With multiple threads the AMRs are divided over the processes (output order stays the same)'''
+    blocks = ([block, keep_wiki] for block in read_amr_blocks(input_file))
+    pool = Pool(processes=threads) if threads > 1 else None
+    with open(input_file + out_ext, 'w') as out_f:
+        # Hand out a limited number of AMRs at a time, the pool would otherwise read the whole file at once
+        for batch in iter(lambda: list(islice(blocks, 1000 * threads)), []):
+            amrs = pool.imap(var_free_amr, batch, chunksize=64) if pool else map(var_free_amr, batch)
+            for amr in amrs:
+                if amr:
+                    out_f.write(amr + '\n')
+    if pool:
+        pool.close()
 
 
 if __name__ == "__main__":
@@ -179,10 +239,8 @@ if __name__ == "__main__":
 
     # Do input file or find files in folder
     if not args.folder:
-        var_free_amrs(args.input_file, args.output_ext, args.keep_wiki)
+        var_free_amrs(args.input_file, args.output_ext, args.keep_wiki, args.threads)
     else:
-        for root, dirs, files in os.walk(args.input_file):
-            for f in files:
-                if f.endswith(args.amr_ext):
-                    var_free_amrs(os.path.join(root, f), args.output_ext, args.keep_wiki)
+        # Files are processed in parallel, so the AMRs within a file are not
+        process_folder(args.input_file, args.amr_ext, var_free_amrs, [args.output_ext, args.keep_wiki], args.threads)
 